@@ -264,19 +264,46 @@ export default function Page() {
   // ----------------------------
   // Backend analyze call (FastAPI)
   // ----------------------------
-  async function analyzeWithBackend(file: File, start: number, end: number) {
+  // Song id returned by POST /songs for the current file (upload once, analyze many times)
+  const songIdRef = useRef<{ file: File; id: string } | null>(null);
+  // Per-tab key: a newer analyze request cancels this tab's older one server-side
+  const requestKeyRef = useRef(Math.random().toString(36).slice(2));
+
+  async function uploadSong(file: File) {
     const fd = new FormData();
     // IMPORTANT: this must match FastAPI param name: audio: UploadFile = File(...)
     fd.append("audio", file);
 
-    const url = new URL("http://localhost:8000/analyze");
-    url.searchParams.set("section_start", String(start));
-    url.searchParams.set("section_end", String(end));
-
-    const res = await fetch(url.toString(), {
+    const res = await fetch("http://localhost:8000/songs", {
       method: "POST",
       body: fd,
     });
+    const data = await res.json();
+    if (!data?.ok) throw new Error(data?.error || "Upload failed");
+
+    songIdRef.current = { file, id: data.song_id };
+    return data.song_id as string;
+  }
+
+  async function analyzeWithBackend(file: File, start: number, end: number) {
+    let songId = songIdRef.current?.file === file ? songIdRef.current.id : await uploadSong(file);
+
+    const analyzeSong = async (id: string) => {
+      const url = new URL(`http://localhost:8000/songs/${id}/analyze`);
+      url.searchParams.set("section_start", String(start));
+      url.searchParams.set("section_end", String(end));
+      url.searchParams.set("request_key", requestKeyRef.current);
+      return await fetch(url.toString(), { method: "POST" });
+    };
+
+    let res = await analyzeSong(songId);
+    if (res.status === 404) {
+      // Server evicted (or restarted without) our song: upload again and retry once
+      songId = await uploadSong(file);
+      res = await analyzeSong(songId);
+    }
+    // Superseded by a newer analysis from this tab; its result will follow
+    if (res.status === 409) return null;
 
     return await res.json();
   }
@@ -305,6 +332,7 @@ export default function Page() {
 
       try {
         const data = await analyzeWithBackend(audioFile, start, end);
+        if (data === null) return;
 
         if (!data?.ok) {
           setBpm(null);
@@ -0,0 +1,170 @@
+import asyncio
+from collections import deque
+import math
+import time
+
+from starlette.responses import StreamingResponse
+
+from metrics import current_timer
+
+
+# ----------------------------
+# Admission control
+# ----------------------------
+# At most max_active requests through a gate at once, up to max_waiting more
+# queue (FIFO) for a slot, and everything beyond that is turned away: 429
+# when the queue is full, 503 when a queued request waited wait_timeout_s
+# without getting in. Both carry Retry-After, estimated from how long recent
+# requests held their slot and how many are ahead.
+#
+# Handlers take a slot (limiter.slot()) only around the work the gate is
+# for, e.g. a render's DSP work, not for cache hits, and give it back as soon
+# as that is done. Only a response mixed while it is sent holds its slot
+# until the body is out (HeldStreamingResponse).
+
+class Overloaded(RuntimeError):
+    status = 503
+
+    def __init__(self, message: str, retry_after_s: int):
+        super().__init__(message)
+        self.retry_after_s = int(retry_after_s)
+
+class QueueFull(Overloaded):
+    status = 429
+
+class QueueTimeout(Overloaded):
+    status = 503
+
+
+class ConcurrencyLimiter:
+    def __init__(self, name: str, max_active: int, max_waiting: int, wait_timeout_s: float):
+        self.name = name
+        self.max_active = max(1, int(max_active))
+        self.max_waiting = max(0, int(max_waiting))
+        self.wait_timeout_s = float(wait_timeout_s)
+        self._active = 0
+        self._waiters: deque = deque()
+        # Moving average of how long a request holds its slot
+        self._hold_s = 1.0
+        # Only touched from the event loop, so no lock
+        self.admitted = 0
+        self.rejected = {"queue_full": 0, "timeout": 0}
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def retry_after(self) -> int:
+        ahead = len(self._waiters) + 1
+        return max(1, math.ceil(self._hold_s * ahead / self.max_active))
+
+    async def acquire(self):
+        if self._active < self.max_active and not self._waiters:
+            self._active += 1
+            self.admitted += 1
+            return
+        if len(self._waiters) >= self.max_waiting:
+            self.rejected["queue_full"] += 1
+            raise QueueFull(f"Too many {self.name} requests in flight; try again later", self.retry_after())
+
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await asyncio.wait_for(fut, timeout=self.wait_timeout_s if self.wait_timeout_s > 0 else None)
+        except asyncio.TimeoutError:
+            if fut.done() and not fut.cancelled():
+                self.release()  # handed a slot just as the wait timed out
+            else:
+                self._discard(fut)
+            self.rejected["timeout"] += 1
+            raise QueueTimeout(
+                f"Waited {self.wait_timeout_s:g}s for a {self.name} slot; try again later", self.retry_after(),
+            )
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()  # a slot was handed over just as we gave up
+            else:
+                self._discard(fut)
+            raise
+        self.admitted += 1
+
+    async def slot(self) -> "Slot":
+        t0 = time.perf_counter()
+        await self.acquire()
+        timer = current_timer.get()
+        if timer is not None:
+            timer.add("admission", time.perf_counter() - t0)
+        return Slot(self)
+
+    def release(self, held_s: float | None = None):
+        if held_s is not None:
+            self._hold_s = 0.8 * self._hold_s + 0.2 * held_s
+        # Hand the slot straight to the longest waiter, if any
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self._active -= 1
+
+    def stats(self) -> dict:
+        return {
+            "gate": self.name,
+            "active": self._active,
+            "waiting": len(self._waiters),
+            "max_active": self.max_active,
+            "max_waiting": self.max_waiting,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+        }
+
+    def _discard(self, fut):
+        try:
+            self._waiters.remove(fut)
+        except ValueError:
+            pass
+
+
+class Slot:
+    # One acquired slot; release() is idempotent, so error paths can always call it
+    def __init__(self, limiter: ConcurrencyLimiter | None):
+        self.limiter = limiter
+        self._t0 = time.perf_counter()
+
+    def release(self):
+        limiter, self.limiter = self.limiter, None
+        if limiter is not None:
+            limiter.release(time.perf_counter() - self._t0)
+
+
+class HeldStreamingResponse(StreamingResponse):
+    # StreamingResponse that gives its slot back once the body has been sent,
+    # or the client has gone away
+    def __init__(self, *args, slot: Slot, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.slot = slot
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.slot.release()
+
+
+def register_metrics(metrics, limiter: ConcurrencyLimiter):
+    def gauge(attr):
+        return lambda: [({"gate": limiter.name}, getattr(limiter, attr))]
+
+    def rejected():
+        return [({"gate": limiter.name, "reason": r}, n) for r, n in sorted(limiter.rejected.items())]
+
+    prefix = f"{metrics.prefix}_admission"
+    metrics.register(f"{prefix}_active", "gauge", "Requests holding an admission slot.", gauge("active"))
+    metrics.register(f"{prefix}_waiting", "gauge", "Requests queued for an admission slot.", gauge("waiting"))
+    metrics.register(f"{prefix}_admitted_total", "counter", "Requests admitted.",
+                     lambda: [({"gate": limiter.name}, limiter.admitted)])
+    metrics.register(f"{prefix}_rejected_total", "counter", "Requests turned away by admission control.", rejected)
@@ -0,0 +1,410 @@
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import soundfile as sf
+
+import dsp
+
+# Benchmarks for the analyze/render hot paths. Results are printed as JSON
+# (with the commit and library versions) so runs can be diffed across commits:
+#
+#   python bench.py > bench.json                  # everything
+#   python bench.py overlay > overlay.json
+#   python bench.py analysis --tolerance 0.05
+#   python bench.py render --song-sec 60 --tempos 120
+#   python bench.py boot --check                  # exit 1 if over the import budget
+
+
+# ----------------------------
+# Timing helpers
+# ----------------------------
+def time_call(fn, *args, repeat: int = 5, **kwargs) -> dict:
+    fn(*args, **kwargs)  # warm-up (allocations, lazy imports)
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(*args, **kwargs)
+        times.append(time.perf_counter() - t0)
+    times = np.array(times)
+    return {
+        "min_ms": float(round(times.min() * 1000, 3)),
+        "median_ms": float(round(np.median(times) * 1000, 3)),
+        "max_ms": float(round(times.max() * 1000, 3)),
+    }
+
+def synthetic_song(duration_sec: float, bpm: float, sr: int, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    # Click-track "song": accented kick on every beat over a bass drone and
+    # noise. Returns (audio, true beat times). No off-beat hats: their
+    # broadband onsets out-score the kick and the tracker locks half a beat
+    # out of phase, which makes the ground-truth comparison meaningless.
+    rng = np.random.default_rng(seed)
+    n = int(round(duration_sec * sr))
+    t = np.arange(n) / sr
+    y = 0.05 * np.sin(2 * np.pi * 55.0 * t) + 0.01 * rng.standard_normal(n)
+
+    spb = 60.0 / bpm
+    beats = np.arange(0.0, duration_sec, spb)
+    click_t = np.arange(int(0.05 * sr)) / sr
+    kick = np.sin(2 * np.pi * 90.0 * click_t) * np.exp(-click_t * 60.0)
+    for i, b in enumerate(beats):
+        s = int(round(b * sr))
+        e = min(n, s + len(kick))
+        if s < n:
+            y[s:e] += (1.0 if i % 4 == 0 else 0.7) * kick[: e - s]
+    return (y / np.max(np.abs(y))).astype(np.float32), beats.astype(np.float32)
+
+def wav_bytes(y: np.ndarray, sr: int) -> bytes:
+    buf = io.BytesIO()
+    sf.write(buf, y, sr, format="WAV", subtype="PCM_16")
+    return buf.getvalue()
+
+def match_beats(reference: np.ndarray, estimate: np.ndarray, tolerance: float) -> dict:
+    # Nearest-estimate error for every reference beat
+    if len(reference) == 0 or len(estimate) == 0:
+        return {"matched": 0.0, "median_err_ms": None, "max_err_ms": None}
+    err = np.abs(reference[:, None] - estimate[None, :]).min(axis=1)
+    return {
+        "matched": float(round(np.mean(err <= tolerance), 4)),
+        "median_err_ms": float(round(np.median(err) * 1000, 2)),
+        "max_err_ms": float(round(np.max(err) * 1000, 2)),
+    }
+
+def synthetic_voices(sr: int, sample_sec: float = 0.3, seed: int = 0) -> dict:
+    rng = np.random.default_rng(seed)
+    n = int(round(sample_sec * sr))
+    env = np.linspace(1.0, 0.0, n, dtype=np.float32)
+    return {k: (rng.standard_normal(n).astype(np.float32) * env * 0.1) for k in range(1, 9)}
+
+def synthetic_events(section_sec: float, bpm: float, subdivisions: int):
+    spb = 60.0 / bpm / subdivisions
+    times = np.arange(0.0, section_sec, spb, dtype=np.float64)
+    counts = (np.arange(len(times)) % 8) + 1
+    gains = np.where(counts == 1, 1.7, 1.0).astype(np.float32)
+    return times, counts, gains
+
+
+# ----------------------------
+# Overlay: per-count buffers (previous render path) vs single-pass engine
+# ----------------------------
+def legacy_voice_track(length_samples: int, sr: int, times: np.ndarray, counts: np.ndarray,
+                       gains: np.ndarray, voices: dict) -> np.ndarray:
+    # The render loop as it was: one full-length buffer per count, filled by
+    # a per-beat Python loop, then summed.
+    def overlay(times_sec, sample_audio, gains):
+        out = np.zeros(length_samples, dtype=np.float32)
+        for t, g in zip(times_sec, gains):
+            start = int(round(float(t) * sr))
+            if start >= length_samples:
+                continue
+            end = min(length_samples, start + len(sample_audio))
+            out[start:end] += float(g) * sample_audio[: end - start]
+        return out
+
+    voice_track = np.zeros(length_samples, dtype=np.float32)
+    for k in range(1, 9):
+        idx = np.where(counts == k)[0]
+        if idx.size == 0:
+            continue
+        voice_track += overlay(times[idx], voices[k], gains[idx])
+    return voice_track
+
+def bench_overlay(args) -> list[dict]:
+    results = []
+    voices = synthetic_voices(args.sr)
+    for section_sec in args.section_sec:
+        for sub in args.subdivisions:
+            times, counts, gains = synthetic_events(section_sec, args.bpm, sub)
+            n = int(round(section_sec * args.sr))
+
+            ref = legacy_voice_track(n, args.sr, times, counts, gains, voices)
+            new = dsp.overlay_events(n, args.sr, times, counts, voices, gains)
+            max_err = float(np.max(np.abs(ref - new)))
+
+            legacy = time_call(legacy_voice_track, n, args.sr, times, counts, gains, voices, repeat=args.repeat)
+            engine = time_call(dsp.overlay_events, n, args.sr, times, counts, voices, gains, repeat=args.repeat)
+            # All events with one sample (the single-label entry point)
+            single = time_call(dsp.overlay_samples_at_times, n, args.sr, times, voices[1], gains,
+                               repeat=args.repeat)
+            # render_engine=fft: per-label impulse trains, overlap-add convolution
+            fft = dsp.convolve_events(n, args.sr, times, counts, voices, gains)
+            fft_time = time_call(dsp.convolve_events, n, args.sr, times, counts, voices, gains, repeat=args.repeat)
+            fft_single = time_call(dsp.convolve_events, n, args.sr, times, np.zeros(len(times), dtype=np.int64),
+                                   {0: voices[1]}, gains, repeat=args.repeat)
+            results.append({
+                "bench": "overlay",
+                "section_sec": section_sec,
+                "subdivisions": sub,
+                "events": int(len(times)),
+                "sr": args.sr,
+                "legacy": legacy,
+                "engine": engine,
+                "single_sample": single,
+                "fft": fft_time,
+                "fft_single_sample": fft_single,
+                "speedup": float(round(legacy["median_ms"] / max(engine["median_ms"], 1e-9), 2)),
+                "fft_vs_engine": float(round(engine["median_ms"] / max(fft_time["median_ms"], 1e-9), 4)),
+                "max_abs_err": max_err,
+                "fft_max_abs_err": float(np.max(np.abs(new - fft))),
+            })
+    return results
+
+
+# ----------------------------
+# Analysis sample rate: latency and beat accuracy vs native-rate tracking
+# ----------------------------
+def bench_analysis(args) -> list[dict]:
+    results = []
+    section = (2.0, args.song_sec - 2.0)
+    for sr in args.song_sr:
+        for bpm in args.tempos:
+            y, truth = synthetic_song(args.song_sec, bpm, sr, seed=int(bpm))
+            # The tracker trims weak beats at the section edges; leave a beat
+            # of margin so those are not counted as misses
+            spb = 60.0 / bpm
+            truth = truth[(truth >= section[0] + spb) & (truth <= section[1] - spb)]
+            _, native = dsp.beat_track_section(y, sr, *section, analysis_sr=None)
+            for analysis_sr in args.analysis_sr:
+                timing = time_call(dsp.beat_track_section, y, sr, *section,
+                                   analysis_sr=analysis_sr, repeat=args.repeat)
+                est_bpm, beats = dsp.beat_track_section(y, sr, *section, analysis_sr=analysis_sr)
+                vs_native = match_beats(native, beats, args.tolerance)
+                vs_truth = match_beats(truth, beats, args.tolerance)
+                results.append({
+                    "bench": "analysis",
+                    "song_sr": sr,
+                    "true_bpm": bpm,
+                    "analysis_sr": dsp.analysis_rate(sr, analysis_sr),
+                    "bpm": float(round(est_bpm, 2)),
+                    "timing": timing,
+                    "vs_native": vs_native,
+                    "vs_truth": vs_truth,
+                    "tolerance_ms": args.tolerance * 1000,
+                    "within_tolerance": (vs_native["matched"] >= args.min_matched
+                                         and vs_truth["matched"] >= args.min_matched_truth),
+                })
+    return results
+
+
+# ----------------------------
+# Beat tracking: one section per synthetic song
+# ----------------------------
+def bench_beat_track(args) -> list[dict]:
+    results = []
+    for sr in args.song_sr:
+        for bpm in args.tempos:
+            y, _ = synthetic_song(args.song_sec, bpm, sr, seed=int(bpm))
+            start, end = 0.0, args.song_sec
+            est_bpm, beats = dsp.beat_track_section(y, sr, start, end, analysis_sr=args.bench_analysis_sr)
+            results.append({
+                "bench": "beat_track",
+                "song_sec": args.song_sec,
+                "song_sr": sr,
+                "true_bpm": bpm,
+                "analysis_sr": dsp.analysis_rate(sr, args.bench_analysis_sr),
+                "bpm": float(round(est_bpm, 2)),
+                "beats": int(len(beats)),
+                "section": time_call(dsp.beat_track_section, y, sr, start, end,
+                                     analysis_sr=args.bench_analysis_sr, repeat=args.repeat),
+                "envelope": time_call(dsp.analyze_envelope, y, sr, dsp.SECTION_HOP_LENGTH,
+                                      args.bench_analysis_sr, repeat=args.repeat),
+            })
+    return results
+
+
+# ----------------------------
+# Voice preparation: resample/trim/RMS (base) and crop/fade (variant)
+# ----------------------------
+def bench_voices(args) -> list[dict]:
+    results = []
+    for voice_sr in args.voice_sr:
+        pack = {k: (v, voice_sr) for k, v in synthetic_voices(voice_sr).items()}
+        for sr in args.song_sr:
+            bases = dsp.prepare_voice_bases(pack, sr, 0.13)
+            max_voice_sec, fade_sec = dsp.voice_timing(np.arange(0.0, 8.0, 60.0 / args.bpm), args.bpm)
+
+            def finish_all():
+                return {k: dsp.finish_voice(b, sr, max_voice_sec, fade_sec) for k, b in bases.items()}
+
+            entry = dsp.resample_voices(pack, [sr])[sr]
+            results.append({
+                "bench": "voices",
+                "voice_sr": voice_sr,
+                "song_sr": sr,
+                "base": time_call(dsp.prepare_voice_bases, pack, sr, 0.13, repeat=args.repeat),
+                "base_from_bank": time_call(dsp.match_voice_rms, entry, 0.13, repeat=args.repeat),
+                "variant": time_call(finish_all, repeat=args.repeat),
+            })
+    return results
+
+
+# ----------------------------
+# Full /render through the ASGI app (upload, decode, track, voices, mix, encode)
+# ----------------------------
+def bench_render(args) -> list[dict]:
+    # Disable the output/stem caches so every call runs the whole pipeline;
+    # voice variants stay cached, as in steady-state serving.
+    os.environ.setdefault("COUNTCOACH_RENDER_CACHE_MB", "0")
+    os.environ.setdefault("COUNTCOACH_STEM_CACHE_MB", "0")
+    from fastapi.testclient import TestClient
+    import main
+
+    results = []
+    with TestClient(main.app) as client:
+        for sr in args.song_sr:
+            for bpm in args.tempos:
+                y, _ = synthetic_song(args.song_sec, bpm, sr, seed=int(bpm))
+                data = wav_bytes(y, sr)
+                params = {"section_start": 1.0, "section_end": args.song_sec - 1.0}
+                r = client.post("/songs", files={"audio": ("bench.wav", data, "audio/wav")})
+                song_id = r.json()["song_id"]
+
+                for output_format in args.formats:
+                    query = dict(params, format=output_format)
+
+                    def upload_render():
+                        r = client.post("/render", params=query,
+                                        files={"audio": ("bench.wav", data, "audio/wav")})
+                        if r.status_code != 200:
+                            raise RuntimeError(r.text)
+                        return r.content
+
+                    def song_render():
+                        r = client.post(f"/songs/{song_id}/render", params=query)
+                        if r.status_code != 200:
+                            raise RuntimeError(r.text)
+                        return r.content
+
+                    results.append({
+                        "bench": "render",
+                        "song_sec": args.song_sec,
+                        "song_sr": sr,
+                        "true_bpm": bpm,
+                        "format": output_format,
+                        "upload_bytes": len(data),
+                        "output_bytes": len(upload_render()),
+                        "render": time_call(upload_render, repeat=args.repeat),
+                        "song_render": time_call(song_render, repeat=args.repeat),
+                    })
+                client.delete(f"/songs/{song_id}")
+    return results
+
+
+# ----------------------------
+# API process boot (fast-boot mode): import time, first /healthz, and which
+# heavy DSP modules ended up loaded. Each run is a fresh interpreter.
+# ----------------------------
+BOOT_PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import main
+import_s = time.perf_counter() - t0
+from fastapi.testclient import TestClient
+t0 = time.perf_counter()
+r = TestClient(main.app).get("/healthz")  # no lifespan: DSP workers are not started
+healthz_s = time.perf_counter() - t0
+json.dump({"import_s": import_s, "healthz_s": healthz_s, "status": r.status_code,
+           "heavy": main.dsp.heavy_modules_loaded()}, sys.stdout)
+"""
+
+def bench_boot(args) -> list[dict]:
+    env = dict(os.environ, COUNTCOACH_FAST_BOOT="1")
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for _ in range(max(1, args.repeat)):
+        t0 = time.perf_counter()
+        out = subprocess.run([sys.executable, "-c", BOOT_PROBE], capture_output=True, text=True,
+                             cwd=cwd, env=env, check=True).stdout
+        run = json.loads(out)
+        run["process_s"] = time.perf_counter() - t0
+        runs.append(run)
+
+    def ms(key):
+        return float(round(np.median([r[key] for r in runs]) * 1000, 3))
+
+    import_ms = ms("import_s")
+    heavy = sorted({m for r in runs for m in r["heavy"]})
+    return [{
+        "bench": "boot",
+        "import_ms": import_ms,
+        "healthz_ms": ms("healthz_s"),
+        "process_ms": ms("process_s"),
+        "healthz_ok": all(r["status"] == 200 for r in runs),
+        "heavy_modules_loaded": heavy,
+        "import_budget_ms": args.import_budget_ms,
+        "within_budget": import_ms <= args.import_budget_ms and not heavy,
+    }]
+
+
+def run_info() -> dict:
+    import librosa
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5,
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "librosa": librosa.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+BENCHES = {
+    "overlay": bench_overlay,
+    "analysis": bench_analysis,
+    "beat_track": bench_beat_track,
+    "voices": bench_voices,
+    "render": bench_render,
+    "boot": bench_boot,
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Count Coach DSP benchmarks (JSON output)")
+    parser.add_argument("bench", nargs="*", default=list(BENCHES), choices=list(BENCHES))
+    parser.add_argument("--sr", type=int, default=44100)
+    parser.add_argument("--bpm", type=float, default=120.0)
+    parser.add_argument("--section-sec", type=float, nargs="+", default=[15.0, 60.0, 240.0])
+    parser.add_argument("--subdivisions", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--song-sec", type=float, default=30.0)
+    parser.add_argument("--song-sr", type=int, nargs="+", default=[44100, 48000])
+    parser.add_argument("--tempos", type=float, nargs="+", default=[90.0, 100.0, 120.0, 128.0, 140.0])
+    parser.add_argument("--analysis-sr", type=int, nargs="+", default=[0, 22050, 16000, 11025],
+                        help="0 = native rate")
+    parser.add_argument("--tolerance", type=float, default=0.05, help="beat match window (s)")
+    parser.add_argument("--min-matched", type=float, default=0.95,
+                        help="analysis: min share of native-rate beats matched")
+    parser.add_argument("--min-matched-truth", type=float, default=0.9,
+                        help="analysis: min share of true beats matched")
+    parser.add_argument("--bench-analysis-sr", type=int, default=dsp.DEFAULT_ANALYSIS_SR,
+                        help="analysis rate for beat_track (0 = native)")
+    parser.add_argument("--voice-sr", type=int, nargs="+", default=[24000, 44100])
+    parser.add_argument("--formats", nargs="+", default=["wav"], choices=list(dsp.OUTPUT_FORMATS))
+    parser.add_argument("--import-budget-ms", type=float, default=1000.0,
+                        help="boot: max median `import main` time in fast-boot mode")
+    parser.add_argument("--check", action="store_true",
+                        help="exit 1 if any result is outside its tolerance/budget")
+    args = parser.parse_args(argv)
+
+    results = []
+    for name in args.bench:
+        results.extend(BENCHES[name](args))
+    json.dump({"run": run_info(), "results": results}, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+    if args.check and any(r.get(k) is False for r in results for k in ("within_tolerance", "within_budget")):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
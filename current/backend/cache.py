@@ -0,0 +1,199 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+
+# ----------------------------
+# Render result cache
+# ----------------------------
+# Encoded render outputs keyed by a hash of everything that determines the
+# bytes (song content, section, voice pack, mix knobs, output format).
+# Memory tier: LRU bounded by bytes. Optional disk tier: one file per key,
+# evicted oldest-mtime first when over its own byte budget.
+
+# Part of every key. Bump it when a change to the render/mix/encode code
+# changes the bytes a given set of parameters produces, so entries the disk
+# tier kept across the deploy stop matching.
+CACHE_VERSION = 1
+
+def render_key(**params) -> str:
+    params["cache_version"] = CACHE_VERSION
+    blob = json.dumps(params, sort_keys=True, separators=(",", ":"), default=repr)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class RenderCache:
+    def __init__(self, max_bytes: int, disk_dir: str | None = None, disk_max_bytes: int = 0):
+        self.max_bytes = int(max_bytes)
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = int(disk_max_bytes)
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+
+        data = self._disk_get(key)
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+        self._memory_put(key, data)
+        return data
+
+    def put(self, key: str, data: bytes):
+        self._memory_put(key, data)
+        self._disk_put(key, data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "disk_dir": self.disk_dir,
+            }
+
+    def _memory_put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._entries[key] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    # Disk tier
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.bin")
+
+    def _disk_get(self, key: str) -> bytes | None:
+        if not self.disk_dir:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # mtime doubles as last-access for eviction
+            return data
+        except OSError:
+            return None
+
+    def _disk_put(self, key: str, data: bytes):
+        if not self.disk_dir or len(data) > self.disk_max_bytes:
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        self._disk_evict()
+
+    def _disk_evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.disk_dir):
+            if not name.endswith(".bin"):
+                continue
+            path = os.path.join(self.disk_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+# ----------------------------
+# Stem cache
+# ----------------------------
+# Peak-normalized song/voice stems of a render, keyed by everything except
+# the mix knobs, so a gain-only change re-runs just the final mix stage.
+
+class StemCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = int(max_bytes)
+        # key -> (song_base, voice_track, sr)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _size(entry: tuple) -> int:
+        return int(entry[0].nbytes + entry[1].nbytes)
+
+    def get(self, key: str) -> tuple | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, song_base, voice_track, sr: int):
+        entry = (song_base, voice_track, int(sr))
+        size = self._size(entry)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= self._size(old)
+            self._entries[key] = entry
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= self._size(evicted)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,738 @@
+import os
+import time
+
+# librosa marks its numba kernels cache=True; this points the on-disk cache at
+# a persistent, writable place (e.g. a volume, when site-packages is
+# read-only), so new processes load compiled kernels instead of re-JITting.
+# Must be set before numba is imported.
+if os.environ.get("COUNTCOACH_NUMBA_CACHE_DIR"):
+    os.environ.setdefault("NUMBA_CACHE_DIR", os.environ["COUNTCOACH_NUMBA_CACHE_DIR"])
+
+import importlib
+import sys
+import threading
+
+import numpy as np
+import io
+import struct
+import tempfile
+import types
+
+from metrics import stage
+from jobs import write_progress
+from pcm import as_samples, open_pcm, write_pcm
+
+
+class _LazyModule:
+    # Stands in for a module whose real import runs on first attribute
+    # access, so importing dsp (the API process does, for constants and numpy
+    # helpers) doesn't load librosa/scipy/numba/libsndfile; only DSP workers
+    # pay that. importlib's LazyLoader would do the same, but before Python
+    # 3.12 it is not thread-safe: with the thread executor, concurrent first
+    # use sees a half-initialized librosa and fails with AttributeError.
+    _lock = threading.Lock()
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        module = self._module
+        if module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+                module = self._module
+        return getattr(module, attr)
+
+librosa = _LazyModule("librosa")
+sf = _LazyModule("soundfile")
+scipy_signal = _LazyModule("scipy.signal")
+
+# Loaded once a worker actually runs librosa/numba code (see heavy_modules_loaded)
+HEAVY_MODULES = ("librosa.core", "librosa.beat", "librosa.onset", "scipy.signal", "numba")
+
+def heavy_modules_loaded() -> list[str]:
+    return [m for m in HEAVY_MODULES if type(sys.modules.get(m)) is types.ModuleType]
+
+# DSP stages. Everything here is plain top-level functions over numpy arrays
+# and file paths so it can be shipped to worker processes (see workers.py).
+# Steps are wrapped in metrics.stage() so per-stage timings reach /metrics.
+
+SECTION_HOP_LENGTH = 512
+# Beat tracking runs on audio downsampled to this rate (onset strength does
+# not need the top octave); rendering still mixes at the song's native rate.
+DEFAULT_ANALYSIS_SR = 22050
+# Extra audio decoded around a requested section, so formats whose seeks are
+# not sample-accurate (e.g. MP3) still cover the whole window.
+SECTION_DECODE_MARGIN_SEC = 0.5
+
+
+# ----------------------------
+# Helpers (adapted from your script)
+# ----------------------------
+def safe_norm(x: np.ndarray) -> np.ndarray:
+    m = float(np.max(np.abs(x)) + 1e-9)
+    return (x / m) if m > 1.0 else x
+
+def rms(x: np.ndarray) -> float:
+    return float(np.sqrt(np.mean(np.square(x)) + 1e-12))
+
+def match_rms(x: np.ndarray, target_rms: float = 0.13) -> np.ndarray:
+    x = x.astype(np.float32)
+    r = rms(x)
+    if r < 1e-8:
+        return x
+    return x * (target_rms / r)
+
+def soft_clip(x: np.ndarray, clip: float = 0.98) -> np.ndarray:
+    x = x.astype(np.float32)
+    return np.tanh(x / clip) * clip
+
+def crop_to_max_duration(x: np.ndarray, sr: int, max_sec: float) -> np.ndarray:
+    nmax = int(round(max_sec * sr))
+    nmax = max(1, nmax)
+    return x[: min(len(x), nmax)].astype(np.float32)
+
+def fade_out(x: np.ndarray, sr: int, fade_sec: float) -> np.ndarray:
+    x = x.astype(np.float32)
+    n = int(round(fade_sec * sr))
+    if n <= 1 or len(x) <= n:
+        return x
+    w = np.linspace(1.0, 0.0, n, dtype=np.float32)
+    y = x.copy()
+    y[-n:] *= w
+    return y
+
+def overlay_events(length_samples: int, sr: int, times_sec: np.ndarray, labels: np.ndarray,
+                   samples: dict, gains: np.ndarray | None = None) -> np.ndarray:
+    # Single-pass overlay of every event into one buffer. Start indices,
+    # bounds checks and gain scaling are computed in batch; what is left per
+    # event is one contiguous slice-add, which measured faster than scattering
+    # through fancy indexes / np.add.at (see bench.py overlay).
+    times_sec = np.asarray(times_sec, dtype=np.float64)
+    labels = np.asarray(labels)
+    if gains is None:
+        gains = np.ones(len(times_sec), dtype=np.float32)
+    else:
+        gains = np.asarray(gains, dtype=np.float32)
+
+    starts = np.rint(times_sec * sr).astype(np.int64)
+    keep = (starts >= 0) & (starts < length_samples)
+    starts, labels, gains = starts[keep], labels[keep], gains[keep]
+
+    # Pad the tail so events near the end need no per-event truncation
+    max_len = max((len(samples[k]) for k in np.unique(labels)), default=0)
+    buf = np.zeros(length_samples + max_len, dtype=np.float32)
+
+    # One scaled copy per distinct (label, gain), not per event
+    scaled = {}
+    for k, g in set(zip(labels.tolist(), gains.tolist())):
+        scaled[(k, g)] = np.float32(g) * np.asarray(samples[k], dtype=np.float32)
+
+    for s, k, g in zip(starts.tolist(), labels.tolist(), gains.tolist()):
+        samp = scaled[(k, g)]
+        buf[s:s + len(samp)] += samp
+
+    return buf[:length_samples]
+
+def convolve_events(length_samples: int, sr: int, times_sec: np.ndarray, labels: np.ndarray,
+                    samples: dict, gains: np.ndarray | None = None) -> np.ndarray:
+    # FFT engine, same contract as overlay_events: per label, a sparse impulse
+    # train (event gains at their start samples) convolved with that label's
+    # sample by overlap-add. Cost grows with section length and the number of
+    # distinct labels, not with the number of events.
+    times_sec = np.asarray(times_sec, dtype=np.float64)
+    labels = np.asarray(labels)
+    if gains is None:
+        gains = np.ones(len(times_sec), dtype=np.float32)
+    else:
+        gains = np.asarray(gains, dtype=np.float32)
+
+    starts = np.rint(times_sec * sr).astype(np.int64)
+    keep = (starts >= 0) & (starts < length_samples)
+    starts, labels, gains = starts[keep], labels[keep], gains[keep]
+
+    buf = np.zeros(length_samples, dtype=np.float32)
+    for k in np.unique(labels).tolist():
+        samp = np.asarray(samples[k], dtype=np.float32)
+        if len(samp) == 0:
+            continue
+        sel = labels == k
+        train = np.zeros(length_samples, dtype=np.float32)
+        np.add.at(train, starts[sel], gains[sel])  # coinciding events add up
+        buf += scipy_signal.oaconvolve(train, samp)[:length_samples]
+
+    return buf
+
+RENDER_ENGINES = {"overlay": overlay_events, "fft": convolve_events}
+
+def check_render_engine(name: str):
+    if name not in RENDER_ENGINES:
+        raise ValueError(f"Unknown render_engine {name!r}; choose one of {', '.join(RENDER_ENGINES)}")
+
+def overlay_samples_at_times(length_samples: int, sr: int, times_sec: np.ndarray,
+                             sample_audio: np.ndarray, gains: np.ndarray | None = None) -> np.ndarray:
+    labels = np.zeros(len(times_sec), dtype=np.int64)
+    return overlay_events(length_samples, sr, times_sec, labels, {0: sample_audio}, gains)
+
+def decode_audio(path: str) -> tuple[np.ndarray, int]:
+    with stage("decode"):
+        y, sr = librosa.load(path, sr=None, mono=True)
+    return y.astype(np.float32), int(sr)
+
+def decode_window(path: str, start_sec: float, end_sec: float,
+                  margin_sec: float = SECTION_DECODE_MARGIN_SEC) -> tuple[np.ndarray, int, float]:
+    # Decode only [start - margin, end + margin]. Returns the mono window, its
+    # sample rate and the song time of its first sample.
+    with stage("decode"):
+        return _decode_window(path, max(0.0, start_sec - margin_sec), end_sec + margin_sec)
+
+def _decode_window(path: str, start_sec: float, end_sec: float) -> tuple[np.ndarray, int, float]:
+    try:
+        with sf.SoundFile(path) as f:
+            if f.seekable():
+                sr = int(f.samplerate)
+                start = min(int(round(start_sec * sr)), f.frames)
+                n = max(0, int(round(end_sec * sr)) - start)
+                f.seek(start)
+                y = f.read(frames=n, dtype="float32", always_2d=True)
+                return y.mean(axis=1).astype(np.float32), sr, start / sr
+    except RuntimeError:
+        # libsndfile cannot open it (format/codec): let librosa pick a backend
+        pass
+    y, sr = librosa.load(path, sr=None, mono=True, offset=start_sec, duration=max(0.0, end_sec - start_sec))
+    return y.astype(np.float32), int(sr), start_sec
+
+# ----------------------------
+# WAV encoding (in memory, streamed)
+# ----------------------------
+def wav_header(n_frames: int, sr: int, channels: int = 1, bits: int = 16) -> bytes:
+    # Canonical 44-byte RIFF/WAVE header for integer PCM
+    block_align = channels * bits // 8
+    data_size = n_frames * block_align
+    return b"".join([
+        b"RIFF", struct.pack("<I", 36 + data_size), b"WAVE",
+        b"fmt ", struct.pack("<IHHIIHH", 16, 1, channels, sr, sr * block_align, block_align, bits),
+        b"data", struct.pack("<I", data_size),
+    ])
+
+def pcm16_bytes(x: np.ndarray) -> bytes:
+    # Same scaling libsndfile uses for float -> PCM_16
+    return np.clip(np.floor(x * 32768.0), -32768, 32767).astype("<i2").tobytes()
+
+# ----------------------------
+# Beat tracking
+# ----------------------------
+def section_bounds(n_samples: int, sr: int, start_sec: float, end_sec: float) -> tuple[int, int]:
+    start_samp = int(round(max(0.0, start_sec) * sr))
+    end_samp = int(round(min(end_sec, n_samples / sr) * sr))
+    if end_samp <= start_samp:
+        raise ValueError("section_end must be > section_start")
+    if end_samp - start_samp < sr * 3:
+        raise ValueError("Section too short for beat tracking; choose 3–6+ seconds.")
+    return start_samp, end_samp
+
+def analysis_rate(sr: int, analysis_sr: int | None) -> int:
+    # Only ever downsample; 0/None means analyze at the native rate
+    if not analysis_sr or analysis_sr >= sr:
+        return int(sr)
+    return int(analysis_sr)
+
+def to_analysis_rate(y: np.ndarray, sr: int, analysis_sr: int | None) -> tuple[np.ndarray, int]:
+    asr = analysis_rate(sr, analysis_sr)
+    if asr == sr:
+        return y, sr
+    with stage("resample"):
+        return librosa.resample(y, orig_sr=sr, target_sr=asr).astype(np.float32), asr
+
+def beat_track_section(y: np.ndarray, sr: int, start_sec: float, end_sec: float,
+                       analysis_sr: int | None = None):
+    # Slice section
+    start_samp, end_samp = section_bounds(len(y), sr, start_sec, end_sec)
+    y_section = y[start_samp:end_samp].astype(np.float32)
+    y_section, sr = to_analysis_rate(y_section, sr, analysis_sr)
+
+    hop_length = SECTION_HOP_LENGTH
+    with stage("onset"):
+        oenv = librosa.onset.onset_strength(y=y_section, sr=sr, hop_length=hop_length)
+    with stage("beat_track"):
+        tempo, beat_frames = librosa.beat.beat_track(onset_envelope=oenv, sr=sr, hop_length=hop_length)
+
+    beat_times = librosa.frames_to_time(beat_frames, sr=sr, hop_length=hop_length).astype(np.float32)
+
+    # Convert to absolute song times (not relative to section)
+    beat_times_abs = beat_times + float(start_sec)
+
+    # librosa >= 0.10 returns tempo as a 1-element array
+    return float(np.atleast_1d(tempo)[0]), beat_times_abs
+
+def beat_track_window(y: np.ndarray, sr: int, offset_sec: float, start_sec: float, end_sec: float,
+                      analysis_sr: int | None = None):
+    # beat_track_section on a decoded window that starts at song time offset_sec
+    bpm, beat_times = beat_track_section(y, sr, start_sec - offset_sec, end_sec - offset_sec, analysis_sr)
+    return bpm, beat_times + np.float32(offset_sec)
+
+def open_cached_pcm(pcm_path: str | None):
+    # (memmap, sr) for a PCM cache file, or None if there is none (any more)
+    if pcm_path is None:
+        return None
+    try:
+        with stage("pcm_open"):
+            return open_pcm(pcm_path)
+    except (OSError, ValueError):
+        return None
+
+def analyze_file(path: str, start_sec: float, end_sec: float, analysis_sr: int | None = None,
+                 pcm_path: str | None = None):
+    cached = open_cached_pcm(pcm_path)
+    if cached is not None:
+        y, sr = cached
+        bpm, beat_times = beat_track_section(y, sr, start_sec, end_sec, analysis_sr)
+        return sr, bpm, beat_times
+    y, sr, offset = decode_window(path, start_sec, end_sec)
+    bpm, beat_times = beat_track_window(y, sr, offset, start_sec, end_sec, analysis_sr)
+    return sr, bpm, beat_times
+
+# ----------------------------
+# Whole-song analysis (onset envelope computed once, sections sliced from it)
+# ----------------------------
+def analyze_envelope(y: np.ndarray, sr: int, hop_length: int = SECTION_HOP_LENGTH,
+                     analysis_sr: int | None = None):
+    # Returns the envelope, whole-track tempo and beats, and the rate the
+    # envelope frames refer to. y may also be a PCM cache path.
+    y, asr = to_analysis_rate(as_samples(y), sr, analysis_sr)
+    with stage("onset"):
+        oenv = librosa.onset.onset_strength(y=y, sr=asr, hop_length=hop_length).astype(np.float32)
+    with stage("beat_track"):
+        tempo, beat_frames = librosa.beat.beat_track(onset_envelope=oenv, sr=asr, hop_length=hop_length)
+    beat_times = librosa.frames_to_time(beat_frames, sr=asr, hop_length=hop_length).astype(np.float32)
+    return oenv, float(np.atleast_1d(tempo)[0]), beat_times, asr
+
+def decode_and_analyze(path: str, hop_length: int = SECTION_HOP_LENGTH, analysis_sr: int | None = None):
+    y, sr = decode_audio(path)
+    oenv, bpm, beat_times, asr = analyze_envelope(y, sr, hop_length, analysis_sr)
+    return y, sr, oenv, bpm, beat_times, asr
+
+def decode_to_pcm(path: str, pcm_path: str, hop_length: int = SECTION_HOP_LENGTH,
+                  analysis_sr: int | None = None):
+    # decode_and_analyze, but the samples go to the PCM cache file instead of
+    # back through the pool: the caller memmaps pcm_path
+    y, sr = decode_audio(path)
+    with stage("pcm_write"):
+        write_pcm(pcm_path, y, sr)
+    oenv, bpm, beat_times, asr = analyze_envelope(y, sr, hop_length, analysis_sr)
+    return sr, oenv, bpm, beat_times, asr
+
+def envelope_window(oenv: np.ndarray, sr: int, hop_length: int, start_sec: float, end_sec: float):
+    # sr is the envelope's (analysis) rate
+    start_frame = int(round(start_sec * sr / hop_length))
+    end_frame = min(len(oenv), int(round(end_sec * sr / hop_length)) + 1)
+    return start_frame, np.ascontiguousarray(oenv[start_frame:end_frame])
+
+def beat_track_envelope(oenv: np.ndarray, sr: int, hop_length: int, start_frame: int,
+                        start_sec: float, end_sec: float):
+    # Same contract as beat_track_section, but only re-runs tempo estimation
+    # and the beat DP on a window of a precomputed onset envelope.
+    with stage("beat_track"):
+        tempo, beat_frames = librosa.beat.beat_track(onset_envelope=oenv, sr=sr, hop_length=hop_length)
+    beat_times = librosa.frames_to_time(beat_frames + start_frame, sr=sr, hop_length=hop_length).astype(np.float32)
+
+    # Keep beats inside the requested window (frame rounding can add one at the edge)
+    beat_times = beat_times[(beat_times >= float(start_sec)) & (beat_times <= float(end_sec))]
+
+    return float(np.atleast_1d(tempo)[0]), beat_times
+
+def beat_track_sections(oenv: np.ndarray, sr: int, hop_length: int, sections: list,
+                        n_samples: int, song_sr: int, offset_sec: float = 0.0) -> list:
+    # Many sections on one shared envelope whose frame 0 is at song time
+    # offset_sec (n_samples/song_sr: length of the audio it was computed from).
+    # Returns (bpm, beat_times) per section, or the error message for
+    # sections that are invalid on their own.
+    results = []
+    for start_sec, end_sec in sections:
+        rel_start, rel_end = start_sec - offset_sec, end_sec - offset_sec
+        try:
+            section_bounds(n_samples, song_sr, rel_start, rel_end)
+        except ValueError as e:
+            results.append(str(e))
+            continue
+        start_frame, window = envelope_window(oenv, sr, hop_length, rel_start, rel_end)
+        bpm, beat_times = beat_track_envelope(window, sr, hop_length, start_frame, rel_start, rel_end)
+        results.append((bpm, beat_times + np.float32(offset_sec)))
+    return results
+
+def analyze_file_sections(path: str, sections: list, analysis_sr: int | None = None,
+                          hop_length: int = SECTION_HOP_LENGTH):
+    # One decode and one onset envelope over the span covering every section
+    start_sec = min(s for s, _ in sections)
+    end_sec = max(e for _, e in sections)
+    y, sr, offset = decode_window(path, start_sec, end_sec)
+    y_a, asr = to_analysis_rate(y, sr, analysis_sr)
+    with stage("onset"):
+        oenv = librosa.onset.onset_strength(y=y_a, sr=asr, hop_length=hop_length).astype(np.float32)
+    return sr, beat_track_sections(oenv, asr, hop_length, sections, len(y), sr, offset)
+
+# ----------------------------
+# Render
+# ----------------------------
+def section_slice(y: np.ndarray, sr: int, section_start: float, section_end: float) -> np.ndarray:
+    start_samp = int(round(section_start * sr))
+    end_samp = int(round(section_end * sr))
+    # np.array (not astype) so a memmap source yields a plain in-memory copy
+    return np.array(y[start_samp:end_samp], dtype=np.float32)
+
+def section_beats(beat_times_abs: np.ndarray, section_start: float, section_len: int, sr: int) -> np.ndarray:
+    # Beat times relative to section
+    beat_times = (beat_times_abs - section_start).astype(np.float32)
+    beat_times = beat_times[(beat_times >= 0) & (beat_times <= (section_len / sr))]
+
+    if len(beat_times) < 4:
+        raise ValueError("Too few beats detected in section.")
+    return beat_times
+
+def voice_timing(beat_times: np.ndarray, bpm: float) -> tuple[float, float]:
+    # Voice samples are cropped/faded to fit inside one beat
+    spb = float(np.median(np.diff(beat_times))) if len(beat_times) >= 2 else (60.0 / max(bpm, 1e-6))
+    max_voice_sec = 0.62 * spb
+    fade_sec = min(0.12 * spb, 0.06)
+    return max_voice_sec, fade_sec
+
+def decode_voices(paths: list[str]) -> dict:
+    return {k: decode_audio(path) for k, path in enumerate(paths, start=1)}
+
+def resample_voices(samples: dict, rates) -> dict:
+    # Voice bank entries: every count resampled to each rate and trimmed,
+    # {sr: {count: samples}}. Trimming is relative to the peak, so the result
+    # doesn't depend on the loudness target and serves any target_rms.
+    bank = {}
+    for sr in rates:
+        entry = {}
+        for k, (samp, samp_sr) in samples.items():
+            samp = samp.astype(np.float32)
+            if samp_sr != sr:
+                with stage("resample"):
+                    samp = librosa.resample(samp, orig_sr=samp_sr, target_sr=sr).astype(np.float32)
+            with stage("voice_prep"):
+                entry[k], _ = librosa.effects.trim(samp, top_db=35)
+        bank[int(sr)] = entry
+    return bank
+
+def match_voice_rms(bank_entry: dict, target_rms: float) -> dict:
+    # Loudness match of one bank entry: a gain per sample, cheap enough for the event loop
+    return {k: match_rms(samp, target_rms=target_rms) for k, samp in bank_entry.items()}
+
+def prepare_voice_bases(samples: dict, sr: int, target_rms: float) -> dict:
+    # Resample + trim + loudness match: the expensive, beat-independent part
+    return match_voice_rms(resample_voices(samples, [sr])[int(sr)], target_rms)
+
+def finish_voice(base: np.ndarray, sr: int, max_voice_sec: float, fade_sec: float) -> np.ndarray:
+    samp = crop_to_max_duration(base, sr, max_voice_sec)
+    return fade_out(samp, sr, fade_sec)
+
+def count_events(beat_times: np.ndarray, voice_advance_ms: float) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Counts 1..8 across beats ("1" louder), each placed voice_advance_ms early
+    counts = (np.arange(len(beat_times)) % 8) + 1
+    gains = np.where(counts == 1, 1.7, 1.0).astype(np.float32)
+    times = np.maximum(0.0, beat_times - voice_advance_ms / 1000.0)
+    return times, counts, gains
+
+def render_stems(y_section: np.ndarray, sr: int, beat_times: np.ndarray, voice_samples: dict,
+                 voice_advance_ms: float, engine: str = "overlay") -> tuple[np.ndarray, np.ndarray]:
+    # Peak-normalized song and voice stems; gains are applied by mix_blocks
+    section_len = len(y_section)
+    times, counts, gains = count_events(beat_times, voice_advance_ms)
+    with stage("overlay"):
+        voice_track = RENDER_ENGINES[engine](
+            length_samples=section_len,
+            sr=sr,
+            times_sec=times,
+            labels=counts,
+            samples=voice_samples,
+            gains=gains,
+        )
+
+        # Normalize tracks
+        song_base = (y_section / (np.max(np.abs(y_section)) + 1e-9)).astype(np.float32)
+        voice_track = (voice_track / (np.max(np.abs(voice_track)) + 1e-9)).astype(np.float32)
+    return song_base, voice_track
+
+def mix_blocks(song_base: np.ndarray, voice_track: np.ndarray, song_gain: float, voice_gain: float,
+               block_size: int = 0):
+    # Mix stage (gains + safe_norm + soft_clip) one block at a time. The
+    # safe_norm peak is found in a first pass, so blocks match a whole-array
+    # mix exactly. block_size <= 0 mixes everything as one block.
+    n = len(song_base)
+    block_size = max(1, n) if block_size <= 0 else int(block_size)
+    song_gain, voice_gain = float(song_gain), float(voice_gain)
+
+    peak = 0.0
+    for i in range(0, n, block_size):
+        x = song_base[i:i + block_size] * song_gain + voice_gain * voice_track[i:i + block_size]
+        peak = max(peak, float(np.max(np.abs(x))))
+    m = peak + 1e-9
+
+    for i in range(0, n, block_size):
+        x = song_base[i:i + block_size] * song_gain + voice_gain * voice_track[i:i + block_size]
+        if m > 1.0:
+            x = x / m
+        yield soft_clip(x)
+
+def mix_stems(song_base: np.ndarray, voice_track: np.ndarray, song_gain: float, voice_gain: float) -> np.ndarray:
+    return next(mix_blocks(song_base, voice_track, song_gain, voice_gain), np.zeros(0, dtype=np.float32))
+
+# ----------------------------
+# Compressed outputs (encoded by libsndfile into memory)
+# ----------------------------
+# name -> (libsndfile format, subtype, media type, file extension, sample rates
+# the codec accepts or None for any)
+OUTPUT_FORMATS = {
+    "wav": ("WAV", "PCM_16", "audio/wav", "wav", None),
+    "flac": ("FLAC", "PCM_16", "audio/flac", "flac", None),
+    "opus": ("OGG", "OPUS", "audio/ogg", "opus", (8000, 12000, 16000, 24000, 48000)),
+    "vorbis": ("OGG", "VORBIS", "audio/ogg", "ogg", None),
+    "mp3": ("MP3", "MPEG_LAYER_III", "audio/mpeg", "mp3", None),
+}
+BITRATE_MODES = ("CONSTANT", "AVERAGE", "VARIABLE")
+
+def check_output_format(name: str, compression_level: float | None = None, bitrate_mode: str | None = None):
+    if name not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown format {name!r}; choose one of {', '.join(OUTPUT_FORMATS)}")
+    if compression_level is not None and not (0.0 <= compression_level <= 1.0):
+        raise ValueError("compression_level must be between 0 (best quality) and 1 (smallest)")
+    if bitrate_mode is not None and bitrate_mode.upper() not in BITRATE_MODES:
+        raise ValueError(f"bitrate_mode must be one of {', '.join(m.lower() for m in BITRATE_MODES)}")
+
+def encode_audio(x: np.ndarray, sr: int, name: str, compression_level: float | None = None,
+                 bitrate_mode: str | None = None) -> bytes:
+    check_output_format(name, compression_level, bitrate_mode)
+    fmt, subtype, _, _, rates = OUTPUT_FORMATS[name]
+    if rates is not None and sr not in rates:
+        # e.g. Opus only runs at 8/12/16/24/48 kHz
+        target = min((r for r in rates if r >= sr), default=max(rates))
+        x = librosa.resample(x, orig_sr=sr, target_sr=target).astype(np.float32)
+        sr = target
+
+    buf = io.BytesIO()
+    with stage("encode"):
+        sf.write(
+            buf, x, sr, format=fmt, subtype=subtype,
+            compression_level=compression_level,
+            bitrate_mode=bitrate_mode.upper() if bitrate_mode else None,
+        )
+    return buf.getvalue()
+
+def encode_stems(song_base: np.ndarray, voice_track: np.ndarray, song_gain: float, voice_gain: float,
+                 sr: int, name: str, compression_level: float | None = None,
+                 bitrate_mode: str | None = None) -> bytes:
+    with stage("mix"):
+        out = mix_stems(song_base, voice_track, song_gain, voice_gain)
+    return encode_audio(out, sr, name, compression_level, bitrate_mode)
+
+def iter_wav_pcm16(blocks, n_frames: int, sr: int):
+    # Header first (length is known up front), then PCM as blocks are mixed
+    yield wav_header(n_frames, sr)
+    for block in blocks:
+        yield pcm16_bytes(block)
+
+def decode_and_track_section(audio_path: str, section_start: float, section_end: float,
+                             analysis_sr: int | None = None, pcm_path: str | None = None):
+    cached = open_cached_pcm(pcm_path)
+    if cached is not None:
+        y, sr = cached
+        bpm, beat_times_abs = beat_track_section(y, sr, section_start, section_end, analysis_sr)
+        return sr, bpm, beat_times_abs, section_slice(y, sr, section_start, section_end)
+    y, sr, offset = decode_window(audio_path, section_start, section_end)
+    bpm, beat_times_abs = beat_track_window(y, sr, offset, section_start, section_end, analysis_sr)
+    y_section = section_slice(y, sr, section_start - offset, section_end - offset)
+    return sr, bpm, beat_times_abs, y_section
+
+# ----------------------------
+# Block render (full song / several sections)
+# ----------------------------
+# Renders straight from the song samples (normally a PCM memmap) in fixed-size
+# blocks, so memory stays at a couple of blocks however long the output is.
+# A segment is a slice of the song with its own count events:
+#   (start_samp, end_samp, times_sec, counts, gains, voice_samples)
+# with times relative to the segment start; segments play back to back. The
+# stem normalization and safe_norm peaks come from extra passes over the
+# blocks (re-overlaying is cheap next to holding whole stems), so every
+# segment mixes exactly like render_stems + mix_blocks over one long section.
+
+def iter_voice_blocks(n: int, sr: int, times_sec: np.ndarray, labels: np.ndarray, samples: dict,
+                      gains: np.ndarray, block_size: int):
+    # overlay_events one block at a time: each event is added in the block it
+    # starts in and the part running past the block end carries into the next
+    starts = np.rint(np.asarray(times_sec, dtype=np.float64) * sr).astype(np.int64)
+    labels = np.asarray(labels)
+    gains = np.asarray(gains, dtype=np.float32)
+    keep = (starts >= 0) & (starts < n)
+    order = np.argsort(starts[keep], kind="stable")
+    starts, labels, gains = starts[keep][order], labels[keep][order], gains[keep][order]
+
+    max_len = max((len(samples[k]) for k in np.unique(labels).tolist()), default=0)
+    scaled = {}
+    for k, g in set(zip(labels.tolist(), gains.tolist())):
+        scaled[(k, g)] = np.float32(g) * np.asarray(samples[k], dtype=np.float32)
+
+    carry = np.zeros(max_len, dtype=np.float32)
+    for b0 in range(0, n, block_size):
+        size = min(block_size, n - b0)
+        buf = np.zeros(size + max_len, dtype=np.float32)
+        buf[:max_len] += carry
+        lo, hi = np.searchsorted(starts, [b0, b0 + size])
+        for s, k, g in zip(starts[lo:hi].tolist(), labels[lo:hi].tolist(), gains[lo:hi].tolist()):
+            samp = scaled[(k, g)]
+            buf[s - b0:s - b0 + len(samp)] += samp
+        carry = buf[size:].copy()
+        yield buf[:size]
+
+def _segment_blocks(y: np.ndarray, segments: list, sr: int, block_size: int):
+    # (song block, voice block) pairs across all segments, in output order
+    for start, end, times, counts, gains, voices in segments:
+        b0 = start
+        for v in iter_voice_blocks(end - start, sr, times, counts, voices, gains, block_size):
+            yield np.asarray(y[b0:b0 + len(v)], dtype=np.float32), v
+            b0 += len(v)
+
+def _mixed_blocks(y: np.ndarray, segments: list, sr: int, song_gain: float, voice_gain: float,
+                  block_size: int, song_peak: float, voice_peak: float):
+    song_norm, voice_norm = np.float32(song_peak + 1e-9), np.float32(voice_peak + 1e-9)
+    for s, v in _segment_blocks(y, segments, sr, block_size):
+        yield (s / song_norm) * float(song_gain) + float(voice_gain) * (v / voice_norm)
+
+def render_block_peaks(y_or_path, segments: list, sr: int, song_gain: float, voice_gain: float,
+                       block_size: int) -> tuple[float, float, float]:
+    # The two analysis passes of a block render: (song peak, voice peak, mix
+    # peak). Separate from the final pass so a streamed render can run these
+    # on the DSP pool and only mix the last pass as the client reads.
+    y = as_samples(y_or_path)
+    block_size = max(1, int(block_size))
+    with stage("overlay"):
+        song_peak = voice_peak = 0.0
+        for s, v in _segment_blocks(y, segments, sr, block_size):
+            song_peak = max(song_peak, float(np.max(np.abs(s))))
+            voice_peak = max(voice_peak, float(np.max(np.abs(v))))
+    with stage("mix"):
+        peak = 0.0
+        for x in _mixed_blocks(y, segments, sr, song_gain, voice_gain, block_size, song_peak, voice_peak):
+            peak = max(peak, float(np.max(np.abs(x))))
+    return song_peak, voice_peak, peak
+
+def iter_render_blocks(y_or_path, segments: list, sr: int, song_gain: float, voice_gain: float,
+                       block_size: int, peaks: tuple[float, float, float]):
+    # Final pass: normalized, limited output blocks given render_block_peaks()
+    y = as_samples(y_or_path)
+    song_peak, voice_peak, peak = peaks
+    m = peak + 1e-9
+    for x in _mixed_blocks(y, segments, sr, song_gain, voice_gain, max(1, int(block_size)), song_peak, voice_peak):
+        if m > 1.0:
+            x = x / m
+        yield soft_clip(x)
+
+def render_blocks(y_or_path, segments: list, sr: int, song_gain: float, voice_gain: float,
+                  block_size: int):
+    y = as_samples(y_or_path)
+    peaks = render_block_peaks(y, segments, sr, song_gain, voice_gain, block_size)
+    yield from iter_render_blocks(y, segments, sr, song_gain, voice_gain, block_size, peaks)
+
+def check_block_format(name: str, sr: int):
+    # Block encoding can't resample on the fly, so codecs with fixed rates
+    # (Opus) need a song already at one of them
+    rates = OUTPUT_FORMATS[name][4]
+    if rates is not None and sr not in rates:
+        raise ValueError(
+            f"{name} full renders need a song sampled at one of {', '.join(map(str, rates))} Hz (this one is {sr} Hz)"
+        )
+
+def render_blocks_to_file(y_or_path, segments: list, sr: int, song_gain: float, voice_gain: float,
+                          block_size: int, name: str, compression_level: float | None = None,
+                          bitrate_mode: str | None = None, path: str | None = None,
+                          progress_path: str | None = None) -> str:
+    # Blocks encoded into a file as they are mixed (libsndfile finalizes
+    # compressed headers with seeks): path, or a new temp file. Returns the
+    # path. progress_path gets the fraction written so far (see jobs.py).
+    check_output_format(name, compression_level, bitrate_mode)
+    check_block_format(name, sr)
+    fmt, subtype, _, ext, _ = OUTPUT_FORMATS[name]
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix=f".{ext}")
+        os.close(fd)
+    total = max(1, sum(end - start for start, end, *_ in segments))
+    written, reported_at = 0, time.perf_counter()
+    try:
+        blocks = render_blocks(y_or_path, segments, sr, song_gain, voice_gain, block_size)
+        with sf.SoundFile(
+            path, "w", samplerate=sr, channels=1, format=fmt, subtype=subtype,
+            compression_level=compression_level,
+            bitrate_mode=bitrate_mode.upper() if bitrate_mode else None,
+        ) as f:
+            for block in blocks:
+                with stage("encode"):
+                    f.write(block)
+                written += len(block)
+                if progress_path and time.perf_counter() - reported_at > 0.25:
+                    write_progress(progress_path, written / total)
+                    reported_at = time.perf_counter()
+    except BaseException:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        raise
+    return path
+
+# ----------------------------
+# Warm-up
+# ----------------------------
+# The first call into each librosa stage pays lazy submodule imports, numba
+# compilation/cache loading and codec setup (seconds, per process). Running
+# the whole analyze + render pipeline once on a tiny synthetic click track
+# moves that cost to process start-up (DSPPool initializer).
+
+def warm_up(sr: int = 44100, analysis_sr: int | None = DEFAULT_ANALYSIS_SR) -> dict:
+    timings = {}
+    t0 = time.perf_counter()
+
+    def mark(name):
+        nonlocal t0
+        now = time.perf_counter()
+        timings[name] = round(now - t0, 4)
+        t0 = now
+
+    rng = np.random.default_rng(0)
+    n = 4 * sr
+    y = 0.01 * rng.standard_normal(n).astype(np.float32)
+    click = np.exp(-np.arange(int(0.03 * sr)) / (0.004 * sr)).astype(np.float32)
+    beats = np.arange(0.0, 4.0, 0.5)
+    for b in beats:
+        s = int(b * sr)
+        y[s:s + len(click)] += click[: n - s]
+
+    bpm, beat_times = beat_track_section(y, sr, 0.0, 4.0, analysis_sr)
+    mark("beat_track_section")
+    oenv, _, _, asr = analyze_envelope(y, sr, SECTION_HOP_LENGTH, analysis_sr)
+    start_frame, window = envelope_window(oenv, asr, SECTION_HOP_LENGTH, 0.0, 4.0)
+    beat_track_envelope(window, asr, SECTION_HOP_LENGTH, start_frame, 0.0, 4.0)
+    mark("envelope")
+
+    voice = (0.1 * rng.standard_normal(int(0.2 * 24000)) * np.linspace(1, 0, int(0.2 * 24000))).astype(np.float32)
+    bases = prepare_voice_bases({k: (voice, 24000) for k in range(1, 9)}, sr, 0.13)
+    max_voice_sec, fade_sec = voice_timing(beats, 120.0)
+    samples = {k: finish_voice(b, sr, max_voice_sec, fade_sec) for k, b in bases.items()}
+    mark("voices")
+
+    song_base, voice_track = render_stems(y, sr, beats.astype(np.float32), samples, 70.0)
+    for _ in iter_wav_pcm16(mix_blocks(song_base, voice_track, 0.75, 2.0, sr), n, sr):
+        pass
+    encode_stems(song_base, voice_track, 0.75, 2.0, sr, "flac")
+    mark("render")
+    return timings
+
+def warm_up_worker(analysis_sr: int | None = DEFAULT_ANALYSIS_SR):
+    # Pool initializer: a failure here must not take the worker down (the
+    # executor would mark the whole pool broken); the worker just starts cold.
+    try:
+        warm_up(analysis_sr=analysis_sr)
+    except Exception:
+        pass
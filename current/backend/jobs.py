@@ -0,0 +1,255 @@
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import os
+import time
+import uuid
+
+
+# ----------------------------
+# Background jobs
+# ----------------------------
+# Long renders run as jobs instead of on an open HTTP connection: POST
+# returns a job id at once, clients poll the status and fetch the result
+# file when it is done. A fixed number of runner tasks take jobs from a
+# bounded FIFO (so job throughput is set here, independently of how many
+# requests come in), results are files in a local directory, and finished
+# jobs are forgotten, result file and all, ttl_s after they finish.
+#
+# A job's run(job) coroutine returns (result path, media type, filename) and
+# may update job.stage / job.progress, or have a DSP worker write progress
+# (a fraction, as text) to job.progress_path. on_finish(job), if given, is
+# called once when the job ends in any state, including cancelled while queued.
+
+JOB_STATES = ("queued", "running", "done", "failed", "cancelled")
+
+
+class JobQueueFull(RuntimeError):
+    pass
+
+class UnknownJob(LookupError):
+    pass
+
+class JobNotReady(RuntimeError):
+    pass
+
+
+@dataclass
+class Job:
+    job_id: str
+    kind: str
+    run: object = field(repr=False)
+    status: str = "queued"
+    stage: str | None = None
+    progress: float = 0.0
+    error: str | None = None
+    result_path: str | None = None
+    media_type: str | None = None
+    filename: str | None = None
+    progress_path: str | None = None
+    on_finish: object = field(default=None, repr=False)
+    created_at: float = field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+    task: asyncio.Task | None = field(default=None, repr=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed", "cancelled")
+
+    def read_progress(self) -> float:
+        if self.status == "done":
+            return 1.0
+        if self.status == "running" and self.progress_path:
+            try:
+                with open(self.progress_path) as f:
+                    return max(self.progress, min(1.0, float(f.read() or 0.0)))
+            except (OSError, ValueError):
+                pass
+        return self.progress
+
+
+def write_progress(path: str | None, fraction: float):
+    # Called from DSP workers; atomic so readers never see a partial number
+    if not path:
+        return
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w") as f:
+            f.write(f"{fraction:.4f}")
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+class JobQueue:
+    def __init__(self, result_dir: str, workers: int = 2, max_queued: int = 64, ttl_s: float = 3600.0,
+                 retry_on: tuple = (), retry_delay_s: float = 1.0):
+        self.result_dir = result_dir
+        self.workers = max(1, int(workers))
+        self.max_queued = max(0, int(max_queued))
+        self.ttl_s = float(ttl_s)
+        # Exceptions that mean "try again shortly" (e.g. the DSP pool is full)
+        self.retry_on = tuple(retry_on)
+        self.retry_delay_s = float(retry_delay_s)
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._pending: asyncio.Queue | None = None
+        self._runners: list[asyncio.Task] = []
+        os.makedirs(self.result_dir, exist_ok=True)
+
+    def result_file(self, job_id: str, ext: str) -> str:
+        return os.path.join(self.result_dir, f"{job_id}.{ext}")
+
+    def submit(self, kind: str, run, on_finish=None) -> Job:
+        # run: async fn(job) -> (path, media_type, filename)
+        self.expire()
+        self._start()
+        if self._pending.qsize() >= self.max_queued:
+            raise JobQueueFull(f"Job queue is full ({self.max_queued} waiting); try again later")
+        job_id = uuid.uuid4().hex
+        job = Job(job_id=job_id, kind=kind, run=run, on_finish=on_finish,
+                  progress_path=os.path.join(self.result_dir, f"{job_id}.progress"))
+        self._jobs[job_id] = job
+        self._pending.put_nowait(job)
+        return job
+
+    def get(self, job_id: str) -> Job:
+        self.expire()
+        job = self._jobs.get(job_id)
+        if job is None:
+            raise UnknownJob(f"Unknown or expired job {job_id!r}")
+        return job
+
+    def result(self, job_id: str) -> Job:
+        job = self.get(job_id)
+        if job.status == "failed":
+            raise JobNotReady(f"Job {job_id} failed: {job.error}")
+        if job.status != "done":
+            raise JobNotReady(f"Job {job_id} is {job.status}; poll GET /jobs/{job_id} until it is done")
+        return job
+
+    def cancel(self, job_id: str) -> Job:
+        job = self.get(job_id)
+        if job.status == "queued":
+            # Skipped by the runner that eventually dequeues it
+            self._finish(job, "cancelled")
+        elif job.status == "running" and job.task is not None:
+            job.task.cancel()
+        else:
+            # Finished: drop the result now instead of at expiry
+            self._forget(job)
+        return job
+
+    def position(self, job: Job) -> int | None:
+        # Jobs ahead of this one in the queue (None once it has started)
+        if job.status != "queued":
+            return None
+        return sum(1 for j in self._jobs.values() if j.status == "queued" and j.created_at < job.created_at)
+
+    def info(self, job: Job) -> dict:
+        return {
+            "job_id": job.job_id,
+            "kind": job.kind,
+            "status": job.status,
+            "stage": job.stage,
+            "progress": round(job.read_progress(), 4),
+            "queue_position": self.position(job),
+            "error": job.error,
+            "created_at": job.created_at,
+            "started_at": job.started_at,
+            "finished_at": job.finished_at,
+            "expires_at": job.finished_at + self.ttl_s if job.finished_at is not None else None,
+        }
+
+    def stats(self) -> dict:
+        counts = {state: 0 for state in JOB_STATES}
+        for job in self._jobs.values():
+            counts[job.status] += 1
+        return {"workers": self.workers, "max_queued": self.max_queued, "ttl_s": self.ttl_s, **counts}
+
+    def expire(self):
+        now = time.time()
+        for job in list(self._jobs.values()):
+            if job.finished and job.finished_at + self.ttl_s <= now:
+                self._forget(job)
+        # Files no job owns: output written after its job was cancelled, or
+        # results of an earlier process (job state lives in memory)
+        for name in os.listdir(self.result_dir):
+            path = os.path.join(self.result_dir, name)
+            try:
+                if name.split(".", 1)[0] not in self._jobs and os.path.getmtime(path) + self.ttl_s <= now:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def shutdown(self):
+        for task in self._runners:
+            task.cancel()
+        self._runners = []
+        self._pending = None
+        for job in list(self._jobs.values()):
+            if job.task is not None:
+                job.task.cancel()
+
+    def _start(self):
+        # Runners are created on first use, inside the running event loop
+        if self._runners:
+            return
+        self._pending = asyncio.Queue()
+        self._runners = [asyncio.create_task(self._runner()) for _ in range(self.workers)]
+
+    async def _runner(self):
+        pending = self._pending
+        while True:
+            job = await pending.get()
+            if job.status != "queued":
+                continue
+            job.status = "running"
+            job.started_at = time.time()
+            job.task = asyncio.create_task(self._attempt(job))
+            try:
+                job.result_path, job.media_type, job.filename = await job.task
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    raise  # the runner itself is shutting down
+                self._finish(job, "cancelled")
+            except Exception as e:
+                job.error = str(e) or type(e).__name__
+                self._finish(job, "failed")
+            else:
+                self._finish(job, "done")
+            finally:
+                job.task = None
+
+    async def _attempt(self, job: Job):
+        while True:
+            try:
+                return await job.run(job)
+            except self.retry_on:
+                job.stage = "waiting"
+                await asyncio.sleep(self.retry_delay_s)
+
+    def _finish(self, job: Job, status: str):
+        job.status = status
+        job.finished_at = time.time()
+        self._remove_file(job.progress_path)
+        if status != "done":
+            self._remove_file(job.result_path)
+            job.result_path = None
+        on_finish, job.on_finish = job.on_finish, None
+        if on_finish is not None:
+            on_finish(job)
+
+    def _forget(self, job: Job):
+        self._jobs.pop(job.job_id, None)
+        self._remove_file(job.progress_path)
+        self._remove_file(job.result_path)
+
+    @staticmethod
+    def _remove_file(path: str | None):
+        if path is None:
+            return
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -1,246 +1,1226 @@
-from fastapi import FastAPI, UploadFile, File, Query
+from contextlib import asynccontextmanager, nullcontext
+from functools import partial
+from fastapi import FastAPI, Form, Request, UploadFile, File, Query, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 import numpy as np
-import librosa
-import soundfile as sf
+import asyncio
+import json
 import tempfile
+import time
 import os
 
-app = FastAPI()
+import dsp
+from admission import ConcurrencyLimiter, HeldStreamingResponse, Overloaded, Slot, register_metrics
+from cache import RenderCache, StemCache, render_key
+from jobs import JobNotReady, JobQueue, JobQueueFull, UnknownJob
+from metrics import Metrics, StageTimer, StageTimingMiddleware, collect_stages, current_timer
+from pcm import PCMCache
+from songs import Song, SongStore
+from uploads import RequestSizeLimit, UnsupportedUpload, UploadTooLarge, save_upload
+from voices import (
+    BANK_RATES, DEFAULT_PACK_ID, VOICE_COUNTS, UnknownVoicePack, VoicePack, VoicePackRegistry,
+    base_key, pack_id_for_files, pack_id_for_hashes, variant_key,
+)
+from workers import ClientDisconnected, LatestRequests, PoolBusy, PoolTimeout, Superseded, pool_from_env
+
+# Beat tracking runs at this rate (0 = native); renders still mix at full rate
+ANALYSIS_SR = int(os.environ.get("COUNTCOACH_ANALYSIS_SR", str(dsp.DEFAULT_ANALYSIS_SR)))
+
+# Fast boot (COUNTCOACH_FAST_BOOT=1): the API process imports only the web
+# stack and dsp's numpy helpers, never librosa/scipy/numba (dsp loads those
+# lazily), so it boots in well under a second and /healthz answers at once.
+# DSP always runs in worker processes then; a thread executor would pull
+# librosa into this process on first use.
+FAST_BOOT = os.environ.get("COUNTCOACH_FAST_BOOT", "0") == "1"
+BOOT_T0 = time.perf_counter()
+
+# Warm-up: every DSP worker runs the pipeline once on a synthetic signal as it
+# starts, all workers are started at boot and the default voice pack's bank
+# is built; /readyz reports 503 until then.
+WARMUP = os.environ.get("COUNTCOACH_WARMUP", "1") != "0"
+readiness = {"ready": not WARMUP, "warmup_s": None, "workers": None, "error": None}
+
+# CPU-bound DSP stages run here instead of on the event loop
+# (COUNTCOACH_DSP_WORKERS / _QUEUE / _TIMEOUT_S / _EXECUTOR).
+dsp_pool = pool_from_env(
+    initializer=partial(dsp.warm_up_worker, ANALYSIS_SR) if WARMUP else None,
+    kind="process" if FAST_BOOT else None,
+)
+
+async def warm_up():
+    t0 = time.perf_counter()
+    try:
+        readiness["workers"] = await dsp_pool.start()
+        await ensure_voice_pack(DEFAULT_PACK_ID)
+    except Exception as e:
+        # Still serve; requests just pay the cold start
+        readiness["error"] = str(e)
+    readiness["warmup_s"] = round(time.perf_counter() - t0, 3)
+    readiness["ready"] = True
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warm_task = asyncio.create_task(warm_up()) if WARMUP else None
+    yield
+    if warm_task is not None:
+        warm_task.cancel()
+    job_queue.shutdown()
+    dsp_pool.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+
+# Decoded songs shared across requests (POST /songs uploads once, then
+# /songs/{song_id}/analyze and /songs/{song_id}/render reuse the PCM).
+SONG_CACHE_MB = float(os.environ.get("COUNTCOACH_SONG_CACHE_MB", "512"))
+song_store = SongStore(max_bytes=int(SONG_CACHE_MB * 1024 * 1024))
+
+# Decoded PCM on disk, memory-mapped by the API and every DSP worker
+# (COUNTCOACH_PCM_CACHE_DIR="" keeps decoded songs on the heap instead).
+pcm_cache = PCMCache(
+    cache_dir=os.environ.get(
+        "COUNTCOACH_PCM_CACHE_DIR", os.path.join(tempfile.gettempdir(), "countcoach-pcm"),
+    ),
+    max_bytes=int(float(os.environ.get("COUNTCOACH_PCM_CACHE_MB", "4096")) * 1024 * 1024),
+)
+
+# Registered voice packs; "default" is the bundled public/voice/1..8.mp3
+VOICE_DIR = os.environ.get(
+    "COUNTCOACH_VOICE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "public", "voice"),
+)
+def default_voice_paths() -> list[str]:
+    return [os.path.join(VOICE_DIR, f"{k}.mp3") for k in VOICE_COUNTS]
+
+# Voice samples are pre-resampled at these rates when a pack is registered
+VOICE_BANK_RATES = tuple(
+    int(r) for r in os.environ.get("COUNTCOACH_VOICE_BANK_RATES", ",".join(map(str, BANK_RATES))).split(",") if r.strip()
+)
+# Packs uploaded with a render (v1..v8) rather than via POST /voice-packs are
+# kept in an LRU of this many
+voice_packs = VoicePackRegistry(
+    bank_rates=VOICE_BANK_RATES,
+    max_upload_packs=int(os.environ.get("COUNTCOACH_VOICE_UPLOAD_PACKS", "8")),
+)
+
+# Encoded render outputs; the disk tier is enabled by setting
+# COUNTCOACH_RENDER_CACHE_DIR.
+render_cache = RenderCache(
+    max_bytes=int(float(os.environ.get("COUNTCOACH_RENDER_CACHE_MB", "256")) * 1024 * 1024),
+    disk_dir=os.environ.get("COUNTCOACH_RENDER_CACHE_DIR") or None,
+    disk_max_bytes=int(float(os.environ.get("COUNTCOACH_RENDER_CACHE_DISK_MB", "2048")) * 1024 * 1024),
+)
+# Normalized song/voice stems, so gain-only changes skip straight to the mix
+stem_cache = StemCache(max_bytes=int(float(os.environ.get("COUNTCOACH_STEM_CACHE_MB", "256")) * 1024 * 1024))
+
+# Analyses in flight per request_key (newest wins) and how often a running
+# analysis checks whether its client is still connected
+latest_requests = LatestRequests()
+DISCONNECT_POLL_S = float(os.environ.get("COUNTCOACH_DISCONNECT_POLL_S", "0.25"))
+
+# Upload limits: per file, and per request body (a render carries up to nine
+# files). 0 disables a limit.
+MAX_UPLOAD_MB = float(os.environ.get("COUNTCOACH_MAX_UPLOAD_MB", "100"))
+MAX_REQUEST_MB = float(os.environ.get("COUNTCOACH_MAX_REQUEST_MB", "200"))
+
+# Upper bound on sections per /analyze/batch request
+BATCH_MAX_SECTIONS = int(os.environ.get("COUNTCOACH_BATCH_MAX_SECTIONS", "64"))
+
+# Background render jobs (POST /jobs/render): COUNTCOACH_JOB_WORKERS run at a
+# time, up to COUNTCOACH_JOB_QUEUE more wait, and results stay in
+# COUNTCOACH_JOB_DIR for COUNTCOACH_JOB_TTL_S after the job finishes. A job's
+# DSP tasks may run for COUNTCOACH_JOB_TIMEOUT_S (the request timeout is meant
+# for interactive calls). Job state is per process, so with several API
+# processes clients must poll the one they submitted to.
+job_queue = JobQueue(
+    result_dir=os.environ.get("COUNTCOACH_JOB_DIR", os.path.join(tempfile.gettempdir(), "countcoach-jobs")),
+    workers=int(os.environ.get("COUNTCOACH_JOB_WORKERS", "2")),
+    max_queued=int(os.environ.get("COUNTCOACH_JOB_QUEUE", "64")),
+    ttl_s=float(os.environ.get("COUNTCOACH_JOB_TTL_S", "3600")),
+    retry_on=(PoolBusy,),
+)
+JOB_TIMEOUT_S = float(os.environ.get("COUNTCOACH_JOB_TIMEOUT_S", "1800"))
+
+# Per-stage latency histograms, served at /metrics
+metrics = Metrics()
+
+# Admission control for renders: COUNTCOACH_RENDER_CONCURRENCY at once
+# (default: one per DSP worker), up to COUNTCOACH_RENDER_QUEUE more waiting at
+# most COUNTCOACH_RENDER_QUEUE_TIMEOUT_S; the rest get 429/503 + Retry-After.
+# A slot covers a render's DSP work (render_slot()), not cache hits or
+# sending a finished body. 0 concurrency turns the gate off.
+RENDER_CONCURRENCY = int(os.environ.get("COUNTCOACH_RENDER_CONCURRENCY", str(dsp_pool.workers)))
+render_gate = ConcurrencyLimiter(
+    "render",
+    max_active=RENDER_CONCURRENCY,
+    max_waiting=int(os.environ.get("COUNTCOACH_RENDER_QUEUE", "16")),
+    wait_timeout_s=float(os.environ.get("COUNTCOACH_RENDER_QUEUE_TIMEOUT_S", "30")),
+)
+register_metrics(metrics, render_gate)
+
+app.add_middleware(RequestSizeLimit, max_bytes=int(MAX_REQUEST_MB * 1024 * 1024))
 
-# Allow Next.js dev server
 
+# ----------------------------
+# Stage timing
+# ----------------------------
+# Each request gets a StageTimer (StageTimingMiddleware); stages measured in
+# DSP workers are merged into it by run_dsp.
+app.add_middleware(StageTimingMiddleware, metrics=metrics)
+
+# Allow Next.js dev server. Added last so it is the outermost middleware:
+# rejections sent by the inner ones (413, 429, 503) get CORS headers too,
+# and the browser can read the headers those and the render routes set.
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After", "X-Stems-Id", "X-Render-Cache", "Server-Timing"],
 )
 
+def request_stage(name: str):
+    timer = current_timer.get()
+    return timer.stage(name) if timer is not None else nullcontext()
+
+async def run_dsp(fn, *args, timeout_s: float | None = None):
+    # dsp_pool.run plus the worker's own stage timings; the remainder of the
+    # wall time (queueing, pickling arrays to/from the worker) is "dispatch".
+    t0 = time.perf_counter()
+    result, stages = await dsp_pool.run(collect_stages, fn, *args, timeout_s=timeout_s)
+    timer = current_timer.get()
+    if timer is not None:
+        for name, sec in stages:
+            timer.add(name, sec)
+        timer.add("dispatch", max(0.0, time.perf_counter() - t0 - sum(sec for _, sec in stages)))
+    return result
+
+async def run_cancellable(request: Request, request_key: str | None, coro):
+    # Run coro as its own task, cancelled when the client disconnects or when
+    # a newer request arrives with the same request_key.
+    task = asyncio.ensure_future(coro)
+    if request_key:
+        latest_requests.claim(request_key, task)
+    disconnected = False
+
+    async def watch_disconnect():
+        nonlocal disconnected
+        while not task.done():
+            if await request.is_disconnected():
+                disconnected = True
+                task.cancel()
+                return
+            await asyncio.sleep(DISCONNECT_POLL_S)
+
+    watcher = asyncio.create_task(watch_disconnect())
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if asyncio.current_task().cancelling():
+            raise  # this request itself is being cancelled
+        if disconnected:
+            raise ClientDisconnected("Client disconnected")
+        raise Superseded("Superseded by a newer request with the same request_key")
+    finally:
+        watcher.cancel()
+        if request_key:
+            latest_requests.release(request_key, task)
 
 # ----------------------------
-# Helpers (adapted from your script)
+# Helpers
 # ----------------------------
-def safe_norm(x: np.ndarray) -> np.ndarray:
-    m = float(np.max(np.abs(x)) + 1e-9)
-    return (x / m) if m > 1.0 else x
-
-def rms(x: np.ndarray) -> float:
-    return float(np.sqrt(np.mean(np.square(x)) + 1e-12))
-
-def match_rms(x: np.ndarray, target_rms: float = 0.13) -> np.ndarray:
-    x = x.astype(np.float32)
-    r = rms(x)
-    if r < 1e-8:
-        return x
-    return x * (target_rms / r)
-
-def soft_clip(x: np.ndarray, clip: float = 0.98) -> np.ndarray:
-    x = x.astype(np.float32)
-    return np.tanh(x / clip) * clip
-
-def crop_to_max_duration(x: np.ndarray, sr: int, max_sec: float) -> np.ndarray:
-    nmax = int(round(max_sec * sr))
-    nmax = max(1, nmax)
-    return x[: min(len(x), nmax)].astype(np.float32)
-
-def fade_out(x: np.ndarray, sr: int, fade_sec: float) -> np.ndarray:
-    x = x.astype(np.float32)
-    n = int(round(fade_sec * sr))
-    if n <= 1 or len(x) <= n:
-        return x
-    w = np.linspace(1.0, 0.0, n, dtype=np.float32)
-    y = x.copy()
-    y[-n:] *= w
-    return y
-
-def overlay_samples_at_times(length_samples: int, sr: int, times_sec: np.ndarray,
-                             sample_audio: np.ndarray, gains: np.ndarray | None = None) -> np.ndarray:
-    out = np.zeros(length_samples, dtype=np.float32)
-    sample_audio = sample_audio.astype(np.float32)
-
-    if gains is None:
-        gains = np.ones(len(times_sec), dtype=np.float32)
-    else:
-        gains = gains.astype(np.float32)
+def load_upload_to_temp(upload: UploadFile) -> tuple[str, str]:
+    # Chunked copy to a temp file; returns (path, sha256 of the content)
+    with request_stage("upload"):
+        return save_upload(upload.file, upload.filename, int(MAX_UPLOAD_MB * 1024 * 1024))
 
-    for t, g in zip(times_sec, gains):
-        start = int(round(float(t) * sr))
-        if start >= length_samples:
+def remove_quietly(paths: list[str | None]):
+    for p in paths:
+        if p is None:
             continue
-        end = min(length_samples, start + len(sample_audio))
-        out[start:end] += float(g) * sample_audio[: end - start]
-    return out
+        try:
+            os.remove(p)
+        except:
+            pass
+
+def analysis_response(sr: int, bpm: float, beat_times: np.ndarray) -> dict:
+    return {
+        "ok": True,
+        "sr": int(sr),
+        "bpm": float(round(bpm, 2)),
+        "beat_times": [float(round(t, 6)) for t in beat_times],
+    }
+
+def parse_sections(raw: str) -> list[tuple[float, float]]:
+    # JSON list of [start, end] pairs or {"start": .., "end": ..} objects
+    try:
+        items = json.loads(raw)
+    except ValueError:
+        raise ValueError("sections must be JSON, e.g. [[0, 12.5], [30, 45]]")
+    if not isinstance(items, list) or not items:
+        raise ValueError("sections must be a non-empty list of [start, end] pairs")
+    if len(items) > BATCH_MAX_SECTIONS:
+        raise ValueError(f"Too many sections ({len(items)}); the limit is {BATCH_MAX_SECTIONS}")
+    sections = []
+    for item in items:
+        try:
+            start, end = (item["start"], item["end"]) if isinstance(item, dict) else item
+            sections.append((float(start), float(end)))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"Bad section {item!r}; expected [start, end]")
+    return sections
+
+def batch_response(sr: int, sections: list, results: list) -> dict:
+    out = []
+    for (start, end), res in zip(sections, results):
+        entry = {"section_start": start, "section_end": end}
+        if isinstance(res, str):
+            entry.update(ok=False, error=res)
+        else:
+            entry.update(analysis_response(sr, *res))
+        out.append(entry)
+    return {"ok": True, "sr": int(sr), "sections": out}
+
+def audio_headers(output_format: str, cache_status: str, name: str = "countcoach_section") -> dict:
+    ext = dsp.OUTPUT_FORMATS[output_format][3]
+    return {
+        "Content-Disposition": f'attachment; filename="{name}.{ext}"',
+        "X-Render-Cache": cache_status,
+    }
 
-def load_upload_to_temp(upload: UploadFile) -> str:
-    suffix = os.path.splitext(upload.filename)[1].lower() or ".wav"
-    fd, path = tempfile.mkstemp(suffix=suffix)
-    os.close(fd)
-    with open(path, "wb") as f:
-        f.write(upload.file.read())
-    return path
+async def render_slot() -> Slot:
+    # A render_gate slot; with the gate off, one that holds nothing
+    if RENDER_CONCURRENCY > 0:
+        return await render_gate.slot()
+    return Slot(None)
 
-def beat_track_section(y: np.ndarray, sr: int, start_sec: float, end_sec: float):
-    # Slice section
-    start_samp = int(round(max(0.0, start_sec) * sr))
-    end_samp = int(round(min(end_sec, len(y) / sr) * sr))
-    if end_samp <= start_samp:
-        raise ValueError("section_end must be > section_start")
-    y_section = y[start_samp:end_samp].astype(np.float32)
+def cache_while_streaming(chunks, key: str):
+    # Pass chunks through to the client; store the whole body once complete
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    render_cache.put(key, b"".join(parts))
 
-    if len(y_section) < sr * 3:
-        raise ValueError("Section too short for beat tracking; choose 3–6+ seconds.")
+def wav_stream_response(song_base: np.ndarray, voice_track: np.ndarray, sr: int,
+                        song_gain: float, voice_gain: float, block_sec: float,
+                        cache_key: str | None = None, slot: Slot | None = None) -> StreamingResponse:
+    # PCM_16 WAV encoded in memory and streamed; the final mix runs block by
+    # block as the client reads (Starlette iterates sync generators off-loop),
+    # so a render slot stays held until the body is out.
+    n = len(song_base)
+    block_size = int(round(block_sec * sr)) if block_sec > 0 else 0
+    blocks = dsp.mix_blocks(song_base, voice_track, song_gain, voice_gain, block_size)
+    chunks = dsp.iter_wav_pcm16(blocks, n, sr)
+    if cache_key is not None:
+        chunks = cache_while_streaming(chunks, cache_key)
+    headers = audio_headers("wav", "miss")
+    headers["Content-Length"] = str(len(dsp.wav_header(n, sr)) + 2 * n)
+    if slot is not None:
+        return HeldStreamingResponse(chunks, media_type="audio/wav", headers=headers, slot=slot)
+    return StreamingResponse(chunks, media_type="audio/wav", headers=headers)
 
-    hop_length = 512
-    oenv = librosa.onset.onset_strength(y=y_section, sr=sr, hop_length=hop_length)
-    tempo, beat_frames = librosa.beat.beat_track(onset_envelope=oenv, sr=sr, hop_length=hop_length)
+async def audio_response(song_base: np.ndarray, voice_track: np.ndarray, sr: int,
+                         song_gain: float, voice_gain: float, block_sec: float, output_format: str,
+                         compression_level: float | None, bitrate_mode: str | None,
+                         cache_key: str | None = None, slot: Slot | None = None) -> Response:
+    # Takes over slot: handed to the streamed WAV, released once encoded otherwise
+    if output_format == "wav":
+        return wav_stream_response(song_base, voice_track, sr, song_gain, voice_gain, block_sec, cache_key, slot)
+    # Compressed containers are finalized with seeks (e.g. FLAC STREAMINFO),
+    # so they are encoded whole on the pool and sent as one body.
+    try:
+        data = await run_dsp(
+            dsp.encode_stems, song_base, voice_track, song_gain, voice_gain, sr,
+            output_format, compression_level, bitrate_mode,
+        )
+    finally:
+        if slot is not None:
+            slot.release()
+    if cache_key is not None:
+        render_cache.put(cache_key, data)
+    media_type = dsp.OUTPUT_FORMATS[output_format][2]
+    return Response(content=data, media_type=media_type, headers=audio_headers(output_format, "miss"))
 
-    beat_times = librosa.frames_to_time(beat_frames, sr=sr, hop_length=hop_length).astype(np.float32)
+def iter_file_chunks(path: str, chunk_size: int = 1 << 16):
+    # Stream a temp file and remove it afterwards (also if the client goes away)
+    try:
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        remove_quietly([path])
 
-    # Convert to absolute song times (not relative to section)
-    beat_times_abs = beat_times + float(start_sec)
+def cached_audio_response(data: bytes, output_format: str) -> Response:
+    media_type = dsp.OUTPUT_FORMATS[output_format][2]
+    return Response(content=data, media_type=media_type, headers=audio_headers(output_format, "hit"))
 
-    return float(tempo), beat_times_abs
+# Content address of the bundled pack's files, hashed on first use
+default_pack_cache_id: str | None = None
+
+def pack_cache_id(pack_id: str) -> str:
+    # Cache keys address packs by content. "default" only names whatever
+    # VOICE_DIR holds, which can change between deploys while the disk tier
+    # of the render cache survives, so it is keyed by its file hashes.
+    global default_pack_cache_id
+    if pack_id != DEFAULT_PACK_ID:
+        return pack_id
+    if default_pack_cache_id is None:
+        default_pack_cache_id = pack_id_for_files(default_voice_paths())
+    return default_pack_cache_id
+
+def stems_key(song_hash: str, beat_source: str, pack_id: str, section_start: float, section_end: float,
+              voice_advance_ms: float, voice_target_rms: float, render_engine: str) -> str:
+    return render_key(
+        song=song_hash, beats=beat_source, pack=pack_cache_id(pack_id), analysis_sr=ANALYSIS_SR,
+        section_start=float(section_start), section_end=float(section_end),
+        voice_advance_ms=float(voice_advance_ms), voice_target_rms=float(voice_target_rms),
+        engine=render_engine,
+    )
+
+def render_cache_key(song_hash: str, beat_source: str, pack_id: str, section_start: float, section_end: float,
+                     voice_advance_ms: float, voice_target_rms: float, render_engine: str, song_gain: float,
+                     voice_gain: float, output_format: str, compression_level: float | None,
+                     bitrate_mode: str | None) -> str:
+    return render_key(
+        song=song_hash, beats=beat_source, pack=pack_cache_id(pack_id), analysis_sr=ANALYSIS_SR,
+        section_start=float(section_start), section_end=float(section_end),
+        voice_advance_ms=float(voice_advance_ms), voice_target_rms=float(voice_target_rms),
+        engine=render_engine,
+        song_gain=float(song_gain), voice_gain=float(voice_gain),
+        format=output_format, compression_level=compression_level,
+        bitrate_mode=bitrate_mode.upper() if bitrate_mode else None,
+    )
+
+def error_response(e: Exception) -> JSONResponse:
+    if isinstance(e, Overloaded):
+        return JSONResponse(
+            status_code=e.status, headers={"Retry-After": str(e.retry_after_s)},
+            content={"ok": False, "error": str(e), "retry_after_s": e.retry_after_s},
+        )
+    if isinstance(e, (UnknownVoicePack, UnknownJob)):
+        return JSONResponse(status_code=404, content={"ok": False, "error": str(e)})
+    if isinstance(e, JobNotReady):
+        return JSONResponse(status_code=409, content={"ok": False, "error": str(e)})
+    if isinstance(e, UploadTooLarge):
+        return JSONResponse(status_code=413, content={"ok": False, "error": str(e)})
+    if isinstance(e, UnsupportedUpload):
+        return JSONResponse(status_code=415, content={"ok": False, "error": str(e)})
+    if isinstance(e, (PoolBusy, JobQueueFull)):
+        return JSONResponse(status_code=503, content={"ok": False, "error": str(e)})
+    if isinstance(e, PoolTimeout):
+        return JSONResponse(status_code=504, content={"ok": False, "error": str(e)})
+    if isinstance(e, Superseded):
+        return JSONResponse(status_code=409, content={"ok": False, "error": str(e)})
+    if isinstance(e, ClientDisconnected):
+        # Nobody is listening; the status only shows up in /metrics
+        return JSONResponse(status_code=499, content={"ok": False, "error": str(e)})
+    return JSONResponse(status_code=400, content={"ok": False, "error": str(e)})
+
+def unknown_song(song_id: str) -> JSONResponse:
+    return JSONResponse(
+        status_code=404,
+        content={"ok": False, "error": f"Unknown song_id {song_id!r}; upload it via POST /songs"},
+    )
+
+# ----------------------------
+# Song analysis (runs on dsp_pool)
+# ----------------------------
+def song_samples(song: Song):
+    # What to ship to a worker: the PCM cache path (the worker maps it) while
+    # the file exists, else the samples themselves
+    if song.pcm_path is not None and os.path.exists(song.pcm_path):
+        return song.pcm_path
+    return np.asarray(song.y)
+
+def cached_pcm_path(song_hash: str) -> str | None:
+    return pcm_cache.path(song_hash) if pcm_cache.exists(song_hash) else None
+
+async def load_song(song_id: str, audio_path: str) -> tuple[Song, bool]:
+    # Song for an upload: mapped from the PCM cache if this content was
+    # decoded before, else decoded now. Returns (song, decoded).
+    cached = pcm_cache.open(song_id)
+    if cached is not None:
+        y, sr = cached
+        song = Song(song_id=song_id, y=y, sr=sr, pcm_path=pcm_cache.path(song_id))
+        # Only the samples are cached; start whole-track analysis now rather
+        # than on the first analyze
+        start_song_analysis(song)
+        return song, False
+
+    if not pcm_cache.enabled:
+        y, sr, oenv, bpm, beat_times, asr = await run_dsp(
+            dsp.decode_and_analyze, audio_path, dsp.SECTION_HOP_LENGTH, ANALYSIS_SR,
+        )
+        return Song(song_id=song_id, y=y, sr=sr, analysis_sr=asr, oenv=oenv, bpm=bpm, beat_times=beat_times), True
+
+    pcm_path = pcm_cache.path(song_id)
+    sr, oenv, bpm, beat_times, asr = await run_dsp(
+        dsp.decode_to_pcm, audio_path, pcm_path, dsp.SECTION_HOP_LENGTH, ANALYSIS_SR,
+    )
+    y, sr = pcm_cache.open(song_id) or (None, sr)
+    if y is None:
+        raise RuntimeError("Decoded song vanished from the PCM cache")
+    # Map before evicting: an unlinked file stays readable while mapped
+    pcm_cache.evict()
+    song = Song(song_id=song_id, y=y, sr=sr, analysis_sr=asr, oenv=oenv, bpm=bpm,
+                beat_times=beat_times, pcm_path=pcm_path)
+    return song, True
+
+async def run_song_analysis(song: Song):
+    try:
+        oenv, bpm, beat_times, asr = await run_dsp(
+            dsp.analyze_envelope, song_samples(song), song.sr, song.hop_length, ANALYSIS_SR,
+        )
+    except BaseException:
+        song.analysis_task = None  # the next request tries again
+        raise
+    song.analysis_sr = asr
+    song.bpm = bpm
+    song.beat_times = beat_times
+    # Publish the envelope last: other requests treat it as "analysis done"
+    song.oenv = oenv
+
+def start_song_analysis(song: Song) -> asyncio.Task | None:
+    if song.oenv is not None:
+        return None
+    if song.analysis_task is None:
+        task = asyncio.create_task(run_song_analysis(song))
+        # Failures reach whoever awaits; don't also log them as unretrieved
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        song.analysis_task = task
+    return song.analysis_task
+
+async def ensure_song_analysis(song: Song) -> Song:
+    task = start_song_analysis(song)
+    if task is not None:
+        # Shielded: a superseded or disconnected request stops waiting, but
+        # the analysis carries on for the next one instead of being redone
+        await asyncio.shield(task)
+    return song
+
+async def beat_track_song_section(song: Song, start_sec: float, end_sec: float):
+    start_samp, end_samp = dsp.section_bounds(len(song.y), song.sr, start_sec, end_sec)
+    await ensure_song_analysis(song)
+    start_frame, oenv = dsp.envelope_window(
+        song.oenv, song.analysis_sr, song.hop_length, start_samp / song.sr, end_samp / song.sr,
+    )
+    return await run_dsp(
+        dsp.beat_track_envelope, oenv, song.analysis_sr, song.hop_length, start_frame, start_sec, end_sec,
+    )
+
+async def full_render_segments(song: Song, sections: list[tuple[float, float]] | None, pack_id: str,
+                               voice_advance_ms: float, voice_target_rms: float) -> list:
+    # dsp.render_blocks segments: the whole song with its whole-song beats, or
+    # each requested section tracked like /songs/{song_id}/render does
+    if sections is None:
+        await ensure_song_analysis(song)
+        spans = [(0, len(song.y), song.bpm, song.beat_times)]
+    else:
+        spans = []
+        for start_sec, end_sec in sections:
+            start, end = dsp.section_bounds(len(song.y), song.sr, start_sec, end_sec)
+            bpm, beat_times_abs = await beat_track_song_section(song, start_sec, end_sec)
+            spans.append((start, end, bpm, beat_times_abs))
+
+    segments = []
+    for start, end, bpm, beat_times_abs in spans:
+        beat_times = dsp.section_beats(beat_times_abs, start / song.sr, end - start, song.sr)
+        max_voice_sec, fade_sec = dsp.voice_timing(beat_times, bpm)
+        voices = await voice_samples_for(pack_id, song.sr, voice_target_rms, max_voice_sec, fade_sec)
+        times, counts, gains = dsp.count_events(beat_times, voice_advance_ms)
+        segments.append((start, end, times, counts, gains, voices))
+    return segments
+
+# ----------------------------
+# Voice packs
+# ----------------------------
+async def ensure_voice_pack(pack_id: str) -> VoicePack:
+    pack = voice_packs.get(pack_id)
+    if pack is not None:
+        return pack
+    if pack_id != DEFAULT_PACK_ID:
+        raise UnknownVoicePack(f"Unknown voice_pack {pack_id!r}; register it via POST /voice-packs")
+    # Bundled pack is decoded at warm-up, or lazily on first use
+    samples = await run_dsp(dsp.decode_voices, default_voice_paths())
+    return await add_voice_pack(DEFAULT_PACK_ID, samples)
+
+async def add_voice_pack(pack_id: str, samples: dict, pinned: bool = True) -> VoicePack:
+    # Registration builds the voice bank at every common song rate, so renders
+    # at those rates never resample
+    bank = await run_dsp(dsp.resample_voices, samples, voice_packs.bank_rates)
+    pack = voice_packs.add(VoicePack(pack_id=pack_id, samples=samples), pinned=pinned)
+    for sr, entry in bank.items():
+        voice_packs.put_bank(pack_id, sr, entry)
+    return pack
+
+async def voice_bank_for(pack: VoicePack, sr: int) -> dict:
+    entry = voice_packs.get_bank(pack.pack_id, sr)
+    if entry is None:
+        # Uncommon rate: resampled once, then served from the bank's LRU
+        entry = (await run_dsp(dsp.resample_voices, pack.samples, [sr]))[int(sr)]
+        voice_packs.put_bank(pack.pack_id, sr, entry)
+    return entry
+
+async def register_voice_uploads(uploads: list[UploadFile], pinned: bool = True) -> tuple[str, bool]:
+    paths, hashes = [], []
+    try:
+        for vu in uploads:
+            path, digest = load_upload_to_temp(vu)
+            paths.append(path)
+            hashes.append(digest)
+        pack_id = pack_id_for_hashes(hashes)
+        if pack_id in voice_packs:
+            if pinned:
+                voice_packs.pin(pack_id)
+            return pack_id, True
+        samples = await run_dsp(dsp.decode_voices, paths)
+        await add_voice_pack(pack_id, samples, pinned)
+        return pack_id, False
+    finally:
+        remove_quietly(paths)
+
+async def resolve_voice_pack(uploads: list[UploadFile | None], voice_pack: str) -> str:
+    # Renders take either all eight voice uploads or none (then voice_pack)
+    given = [vu for vu in uploads if vu is not None]
+    if not given:
+        return voice_pack
+    if len(given) != len(uploads):
+        raise ValueError("Upload all of v1..v8, or none to use voice_pack")
+    pack_id, _ = await register_voice_uploads(given, pinned=False)
+    return pack_id
+
+async def voice_samples_for(pack_id: str, sr: int, target_rms: float,
+                            max_voice_sec: float, fade_sec: float) -> dict:
+    vkey = variant_key(pack_id, sr, target_rms, max_voice_sec, fade_sec)
+    samples = voice_packs.get_variant(vkey)
+    if samples is not None:
+        return samples
+
+    pack = await ensure_voice_pack(pack_id)
+    bkey = base_key(pack_id, sr, target_rms)
+    bases = voice_packs.get_base(bkey)
+    if bases is None:
+        entry = await voice_bank_for(pack, sr)
+        with request_stage("voice_prep"):
+            bases = dsp.match_voice_rms(entry, target_rms)
+        voice_packs.put_base(bkey, bases)
+
+    with request_stage("voice_prep"):
+        samples = {k: dsp.finish_voice(b, sr, max_voice_sec, fade_sec) for k, b in bases.items()}
+    voice_packs.put_variant(vkey, samples)
+    return samples
+
+async def render_section_stems(y_section: np.ndarray, sr: int, bpm: float, beat_times_abs: np.ndarray,
+                               section_start: float, pack_id: str, voice_advance_ms: float,
+                               voice_target_rms: float, render_engine: str) -> tuple[np.ndarray, np.ndarray]:
+    beat_times = dsp.section_beats(beat_times_abs, section_start, len(y_section), sr)
+    max_voice_sec, fade_sec = dsp.voice_timing(beat_times, bpm)
+    voice_samples = await voice_samples_for(pack_id, sr, voice_target_rms, max_voice_sec, fade_sec)
+    return await run_dsp(
+        dsp.render_stems, y_section, sr, beat_times, voice_samples, voice_advance_ms, render_engine,
+    )
+
+async def render_response(song_hash: str, beat_source: str, load_section, pack_id: str,
+                          section_start: float, section_end: float,
+                          voice_advance_ms: float, voice_target_rms: float, render_engine: str,
+                          song_gain: float, voice_gain: float, block_sec: float,
+                          output_format: str, compression_level: float | None,
+                          bitrate_mode: str | None) -> Response:
+    # Shared by both render endpoints. load_section() -> (sr, bpm, beat_times_abs,
+    # y_section) is only awaited when neither the output nor the stems are cached.
+    # beat_source ("section" or "song") is part of the keys: a section tracked
+    # on its own and one sliced from the whole-song envelope get different beats.
+    cache_key = render_cache_key(
+        song_hash, beat_source, pack_id, section_start, section_end, voice_advance_ms,
+        voice_target_rms, render_engine, song_gain, voice_gain, output_format, compression_level, bitrate_mode,
+    )
+    skey = stems_key(
+        song_hash, beat_source, pack_id, section_start, section_end, voice_advance_ms, voice_target_rms, render_engine,
+    )
+    cached = render_cache.get(cache_key)
+    if cached is not None:
+        response = cached_audio_response(cached, output_format)
+        # Hits get the handle too; if those stems have since been evicted,
+        # /stems/{stems_id}/mix answers 404 and the client renders again
+        response.headers["X-Stems-Id"] = skey
+        return response
+
+    slot = await render_slot()
+    try:
+        stems = stem_cache.get(skey)
+        if stems is None:
+            sr, bpm, beat_times_abs, y_section = await load_section()
+            song_base, voice_track = await render_section_stems(
+                y_section, sr, bpm, beat_times_abs, section_start, pack_id,
+                voice_advance_ms, voice_target_rms, render_engine,
+            )
+            song_base.flags.writeable = False
+            voice_track.flags.writeable = False
+            stem_cache.put(skey, song_base, voice_track, sr)
+        else:
+            song_base, voice_track, sr = stems
+
+        response = await audio_response(
+            song_base, voice_track, sr, song_gain, voice_gain, block_sec,
+            output_format, compression_level, bitrate_mode, cache_key, slot,
+        )
+    except BaseException:
+        slot.release()
+        raise
+    # Handle for POST /stems/{stems_id}/mix (gain-only remix)
+    response.headers["X-Stems-Id"] = skey
+    return response
 
 # ----------------------------
 # API
 # ----------------------------
 
+@app.post("/voice-packs")
+async def upload_voice_pack(
+    v1: UploadFile = File(...),
+    v2: UploadFile = File(...),
+    v3: UploadFile = File(...),
+    v4: UploadFile = File(...),
+    v5: UploadFile = File(...),
+    v6: UploadFile = File(...),
+    v7: UploadFile = File(...),
+    v8: UploadFile = File(...),
+):
+    try:
+        pack_id, cached = await register_voice_uploads([v1, v2, v3, v4, v5, v6, v7, v8])
+        return {"ok": True, "pack_id": pack_id, "cached": cached, "bank_rates": voice_packs.bank_rates_for(pack_id)}
+    except Exception as e:
+        return error_response(e)
+
+
+@app.get("/voice-packs")
+async def list_voice_packs():
+    ids = voice_packs.ids()
+    if DEFAULT_PACK_ID not in ids:
+        ids.insert(0, DEFAULT_PACK_ID)
+    return {"ok": True, "pack_ids": ids}
+
+
+@app.delete("/voice-packs/{pack_id}")
+async def delete_voice_pack(pack_id: str):
+    if not voice_packs.remove(pack_id):
+        return error_response(UnknownVoicePack(f"Unknown voice_pack {pack_id!r}"))
+    return {"ok": True, "pack_id": pack_id}
+
+
+@app.post("/songs")
+async def upload_song(audio: UploadFile = File(...)):
+    audio_path = None
+    try:
+        audio_path, song_id = load_upload_to_temp(audio)
+        song = song_store.get(song_id)
+        cached = song is not None
+        if song is None:
+            song, decoded = await load_song(song_id, audio_path)
+            cached = not decoded
+            song_store.add(song)
+
+        return {
+            "ok": True,
+            "song_id": song_id,
+            "sr": int(song.sr),
+            "duration": float(round(song.duration, 6)),
+            "cached": cached,
+        }
+    except Exception as e:
+        return error_response(e)
+    finally:
+        remove_quietly([audio_path])
+
+
+@app.get("/songs/{song_id}/beats")
+async def song_beats(song_id: str):
+    # Whole-track beat grid computed once at upload
+    song = song_store.get(song_id)
+    if song is None:
+        return unknown_song(song_id)
+    try:
+        await ensure_song_analysis(song)
+        return analysis_response(song.sr, song.bpm, song.beat_times)
+    except Exception as e:
+        return error_response(e)
+
+
+@app.delete("/songs/{song_id}")
+async def delete_song(song_id: str):
+    if not song_store.remove(song_id):
+        return unknown_song(song_id)
+    return {"ok": True, "song_id": song_id}
+
+
+@app.get("/healthz")
+async def healthz():
+    # Liveness: never waits on the DSP pool or warm-up
+    return {
+        "ok": True,
+        "uptime_s": round(time.perf_counter() - BOOT_T0, 3),
+        "fast_boot": FAST_BOOT,
+        "dsp_modules_loaded": dsp.heavy_modules_loaded(),
+    }
+
+
+@app.get("/readyz")
+async def readyz():
+    # 200 once the DSP workers are up and warmed
+    status = 200 if readiness["ready"] else 503
+    return JSONResponse(status_code=status, content={"ok": readiness["ready"], **readiness})
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/render-cache/stats")
+async def render_cache_stats():
+    return {"ok": True, **render_cache.stats(), "stems": stem_cache.stats(), "pcm": pcm_cache.stats(),
+            "jobs": job_queue.stats(), "admission": render_gate.stats(), "voice_packs": voice_packs.stats()}
+
+
 @app.post("/analyze")
 async def analyze(
+    request: Request,
     audio: UploadFile = File(...),
     section_start: float = Query(...),
     section_end: float = Query(...),
+    # a newer request with the same key cancels this one (e.g. one key per session)
+    request_key: str | None = Query(None),
 ):
-    audio_path = load_upload_to_temp(audio)
+    audio_path = None
     try:
-        y, sr = librosa.load(audio_path, sr=None, mono=True)
-        bpm, beat_times = beat_track_section(y, sr, section_start, section_end)
+        audio_path, song_hash = load_upload_to_temp(audio)
+        # Content decoded before (POST /songs) is read from the PCM cache
+        sr, bpm, beat_times = await run_cancellable(request, request_key, run_dsp(
+            dsp.analyze_file, audio_path, section_start, section_end, ANALYSIS_SR,
+            cached_pcm_path(song_hash),
+        ))
+        return analysis_response(sr, bpm, beat_times)
+    except Exception as e:
+        return error_response(e)
+    finally:
+        remove_quietly([audio_path])
 
-        return {
-            "ok": True,
-            "sr": int(sr),
-            "bpm": float(round(bpm, 2)),
-            "beat_times": [float(round(t, 6)) for t in beat_times],
-        }
+
+@app.post("/analyze/batch")
+async def analyze_batch(
+    audio: UploadFile = File(...),
+    # JSON list of [start, end] windows, e.g. [[0, 12.5], [30, 45]]
+    sections: str = Form(...),
+):
+    audio_path = None
+    try:
+        windows = parse_sections(sections)
+        audio_path, _ = load_upload_to_temp(audio)
+        sr, results = await run_dsp(dsp.analyze_file_sections, audio_path, windows, ANALYSIS_SR)
+        return batch_response(sr, windows, results)
     except Exception as e:
-        return JSONResponse(status_code=400, content={"ok": False, "error": str(e)})
+        return error_response(e)
     finally:
+        remove_quietly([audio_path])
+
+
+@app.post("/songs/{song_id}/analyze/batch")
+async def analyze_song_batch(song_id: str, sections: str = Form(...)):
+    song = song_store.get(song_id)
+    if song is None:
+        return unknown_song(song_id)
+    try:
+        windows = parse_sections(sections)
+        await ensure_song_analysis(song)
+        results = await run_dsp(
+            dsp.beat_track_sections, song.oenv, song.analysis_sr, song.hop_length, windows,
+            len(song.y), song.sr,
+        )
+        return batch_response(song.sr, windows, results)
+    except Exception as e:
+        return error_response(e)
+
+
+@app.post("/songs/{song_id}/analyze")
+async def analyze_song(
+    request: Request,
+    song_id: str,
+    section_start: float = Query(...),
+    section_end: float = Query(...),
+    request_key: str | None = Query(None),
+):
+    song = song_store.get(song_id)
+    if song is None:
+        return unknown_song(song_id)
+    try:
+        bpm, beat_times = await run_cancellable(
+            request, request_key, beat_track_song_section(song, section_start, section_end),
+        )
+        return analysis_response(song.sr, bpm, beat_times)
+    except Exception as e:
+        return error_response(e)
+
+
+@app.websocket("/songs/{song_id}/live")
+async def live_analysis(websocket: WebSocket, song_id: str):
+    # Live beat grids while a section is being dragged. The client sends
+    # {"section_start", "section_end", "seq"?} as often as it likes; each
+    # message supersedes the previous one: its analysis is cancelled (queued
+    # pool work is dropped) and only the newest window gets a reply.
+    await websocket.accept()
+    song = song_store.get(song_id)
+    if song is None:
+        await websocket.send_json({"type": "error", "ok": False, "error": f"Unknown song_id {song_id!r}; upload it via POST /songs"})
+        await websocket.close(code=4404)
+        return
+
+    endpoint = "/songs/{song_id}/live"
+    in_flight: asyncio.Task | None = None
+
+    async def analyze_window(seq, start: float, end: float):
+        timer = StageTimer()
+        current_timer.set(timer)
+        reply = {"type": "beats", "seq": seq, "section_start": start, "section_end": end}
         try:
-            os.remove(audio_path)
-        except:
-            pass
+            bpm, beat_times = await beat_track_song_section(song, start, end)
+            reply.update(analysis_response(song.sr, bpm, beat_times))
+            status = 200
+        except asyncio.CancelledError:
+            metrics.count_request(endpoint, 499)
+            raise
+        except Exception as e:
+            reply.update(ok=False, error=str(e))
+            status = 400
+        await websocket.send_json(reply)
+        timer.add("total", timer.elapsed())
+        metrics.observe_timer(endpoint, timer)
+        metrics.count_request(endpoint, status)
+
+    try:
+        while True:
+            try:
+                # Parsed here, not via receive_json(), so a malformed (or
+                # binary) frame gets an error reply instead of closing the socket
+                msg = json.loads(await websocket.receive_text())
+                start, end = float(msg["section_start"]), float(msg["section_end"])
+            except (KeyError, TypeError, ValueError):
+                await websocket.send_json({"type": "error", "ok": False, "error": "Expected {section_start, section_end}"})
+                continue
+            if in_flight is not None and not in_flight.done():
+                in_flight.cancel()
+            in_flight = asyncio.create_task(analyze_window(msg.get("seq"), start, end))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if in_flight is not None:
+            in_flight.cancel()
 
 
 @app.post("/render")
 async def render(
     audio: UploadFile = File(...),
-    # voice files: 1..8 required
-    v1: UploadFile = File(...),
-    v2: UploadFile = File(...),
-    v3: UploadFile = File(...),
-    v4: UploadFile = File(...),
-    v5: UploadFile = File(...),
-    v6: UploadFile = File(...),
-    v7: UploadFile = File(...),
-    v8: UploadFile = File(...),
+    # voice files: all of 1..8, or none to use voice_pack
+    v1: UploadFile | None = File(None),
+    v2: UploadFile | None = File(None),
+    v3: UploadFile | None = File(None),
+    v4: UploadFile | None = File(None),
+    v5: UploadFile | None = File(None),
+    v6: UploadFile | None = File(None),
+    v7: UploadFile | None = File(None),
+    v8: UploadFile | None = File(None),
     section_start: float = Query(...),
     section_end: float = Query(...),
+    voice_pack: str = Query(DEFAULT_PACK_ID),
 
     # knobs (matching your script defaults)
     voice_advance_ms: float = Query(70.0),
     voice_target_rms: float = Query(0.13),
     song_gain: float = Query(0.75),
     voice_gain: float = Query(2.0),
+    # seconds of audio mixed per streamed chunk (0 = mix the whole section first)
+    block_sec: float = Query(1.0),
+    # voice track engine: "overlay" (slice-add per event) or "fft" (impulse
+    # trains convolved by overlap-add); outputs agree to float rounding
+    render_engine: str = Query("overlay"),
+
+    # output encoding: wav (PCM_16, streamed), flac, opus, vorbis, mp3
+    output_format: str = Query("wav", alias="format"),
+    compression_level: float | None = Query(None),
+    bitrate_mode: str | None = Query(None),
 ):
     # Save temp files
-    audio_path = load_upload_to_temp(audio)
-    voice_uploads = [v1, v2, v3, v4, v5, v6, v7, v8]
-    voice_paths = []
-    try:
-        for vu in voice_uploads:
-            voice_paths.append(load_upload_to_temp(vu))
-
-        y, sr = librosa.load(audio_path, sr=None, mono=True)
-        bpm, beat_times_abs = beat_track_section(y, sr, section_start, section_end)
-
-        # Work only in section for rendering
-        start_samp = int(round(section_start * sr))
-        end_samp = int(round(section_end * sr))
-        y_section = y[start_samp:end_samp].astype(np.float32)
-        section_len = len(y_section)
-
-        # Beat times relative to section
-        beat_times = (beat_times_abs - section_start).astype(np.float32)
-        beat_times = beat_times[(beat_times >= 0) & (beat_times <= (section_len / sr))]
-
-        if len(beat_times) < 4:
-            raise ValueError("Too few beats detected in section.")
-
-        spb = float(np.median(np.diff(beat_times))) if len(beat_times) >= 2 else (60.0 / max(bpm, 1e-6))
-        max_voice_sec = 0.62 * spb
-        fade_sec = min(0.12 * spb, 0.06)
-
-        # Load + process voice samples 1..8
-        voice_samples = {}
-        for k, path in enumerate(voice_paths, start=1):
-            samp, samp_sr = librosa.load(path, sr=None, mono=True)
-            samp = samp.astype(np.float32)
-            if samp_sr != sr:
-                samp = librosa.resample(samp, orig_sr=samp_sr, target_sr=sr).astype(np.float32)
-
-            samp, _ = librosa.effects.trim(samp, top_db=35)
-            samp = match_rms(samp, target_rms=voice_target_rms)
-            samp = crop_to_max_duration(samp, sr, max_voice_sec)
-            samp = fade_out(samp, sr, fade_sec)
-            voice_samples[k] = samp
-
-        # Assign counts 1..8 across beats
-        counts = (np.arange(len(beat_times)) % 8) + 1
-        gains = np.where(counts == 1, 1.7, 1.0).astype(np.float32)
-
-        voice_advance_sec = voice_advance_ms / 1000.0
-
-        voice_track = np.zeros(section_len, dtype=np.float32)
-        for k in range(1, 9):
-            idx = np.where(counts == k)[0]
-            if idx.size == 0:
-                continue
-            times_k = np.maximum(0.0, beat_times[idx] - voice_advance_sec)
-            gains_k = gains[idx]
-            voice_track += overlay_samples_at_times(
-                length_samples=section_len,
-                sr=sr,
-                times_sec=times_k,
-                sample_audio=voice_samples[k],
-                gains=gains_k,
+    audio_path = None
+    try:
+        audio_path, song_hash = load_upload_to_temp(audio)
+        dsp.check_output_format(output_format, compression_level, bitrate_mode)
+        dsp.check_render_engine(render_engine)
+        pack_id = await resolve_voice_pack([v1, v2, v3, v4, v5, v6, v7, v8], voice_pack)
+
+        async def load_section():
+            return await run_dsp(
+                dsp.decode_and_track_section, audio_path, section_start, section_end, ANALYSIS_SR,
+                cached_pcm_path(song_hash),
             )
 
-        # Normalize tracks and mix
-        song_base = y_section / (np.max(np.abs(y_section)) + 1e-9)
-        song_base = song_base * float(song_gain)
+        return await render_response(
+            song_hash, "section", load_section, pack_id, section_start, section_end,
+            voice_advance_ms, voice_target_rms, render_engine, song_gain, voice_gain, block_sec,
+            output_format, compression_level, bitrate_mode,
+        )
+    except Exception as e:
+        return error_response(e)
+    finally:
+        remove_quietly([audio_path])
 
-        voice_track = voice_track / (np.max(np.abs(voice_track)) + 1e-9)
 
-        out = safe_norm(song_base + float(voice_gain) * voice_track)
-        out = soft_clip(out)
+@app.post("/songs/{song_id}/render")
+async def render_song(
+    song_id: str,
+    # voice files: all of 1..8, or none to use voice_pack
+    v1: UploadFile | None = File(None),
+    v2: UploadFile | None = File(None),
+    v3: UploadFile | None = File(None),
+    v4: UploadFile | None = File(None),
+    v5: UploadFile | None = File(None),
+    v6: UploadFile | None = File(None),
+    v7: UploadFile | None = File(None),
+    v8: UploadFile | None = File(None),
+    section_start: float = Query(...),
+    section_end: float = Query(...),
+    voice_pack: str = Query(DEFAULT_PACK_ID),
 
-        # Write to temp wav
-        out_path = tempfile.mktemp(suffix=".wav")
-        sf.write(out_path, out, sr)
+    voice_advance_ms: float = Query(70.0),
+    voice_target_rms: float = Query(0.13),
+    song_gain: float = Query(0.75),
+    voice_gain: float = Query(2.0),
+    # seconds of audio mixed per streamed chunk (0 = mix the whole section first)
+    block_sec: float = Query(1.0),
+    # voice track engine: "overlay" (slice-add per event) or "fft" (impulse
+    # trains convolved by overlap-add); outputs agree to float rounding
+    render_engine: str = Query("overlay"),
+
+    # output encoding: wav (PCM_16, streamed), flac, opus, vorbis, mp3
+    output_format: str = Query("wav", alias="format"),
+    compression_level: float | None = Query(None),
+    bitrate_mode: str | None = Query(None),
+):
+    song = song_store.get(song_id)
+    if song is None:
+        return unknown_song(song_id)
+    try:
+        dsp.check_output_format(output_format, compression_level, bitrate_mode)
+        dsp.check_render_engine(render_engine)
+        pack_id = await resolve_voice_pack([v1, v2, v3, v4, v5, v6, v7, v8], voice_pack)
 
-        return FileResponse(out_path, media_type="audio/wav", filename="countcoach_section.wav")
+        async def load_section():
+            bpm, beat_times_abs = await beat_track_song_section(song, section_start, section_end)
+            # Only the section's samples are shipped to the worker
+            y_section = dsp.section_slice(song.y, song.sr, section_start, section_end)
+            return song.sr, bpm, beat_times_abs, y_section
+
+        return await render_response(
+            song_id, "song", load_section, pack_id, section_start, section_end,
+            voice_advance_ms, voice_target_rms, render_engine, song_gain, voice_gain, block_sec,
+            output_format, compression_level, bitrate_mode,
+        )
     except Exception as e:
-        return JSONResponse(status_code=400, content={"ok": False, "error": str(e)})
-    finally:
-        for p in voice_paths:
-            try:
-                os.remove(p)
-            except:
-                pass
+        return error_response(e)
+
+
+@app.post("/songs/{song_id}/render/full")
+async def render_song_full(
+    song_id: str,
+    # voice files: all of 1..8, or none to use voice_pack
+    v1: UploadFile | None = File(None),
+    v2: UploadFile | None = File(None),
+    v3: UploadFile | None = File(None),
+    v4: UploadFile | None = File(None),
+    v5: UploadFile | None = File(None),
+    v6: UploadFile | None = File(None),
+    v7: UploadFile | None = File(None),
+    v8: UploadFile | None = File(None),
+    # JSON [[start, end], ...] rendered back to back; omitted = the whole song
+    sections: str | None = Query(None),
+    voice_pack: str = Query(DEFAULT_PACK_ID),
+
+    voice_advance_ms: float = Query(70.0),
+    voice_target_rms: float = Query(0.13),
+    song_gain: float = Query(0.75),
+    voice_gain: float = Query(2.0),
+    # seconds of audio per block; memory use follows this, not the song length
+    block_sec: float = Query(1.0),
+
+    output_format: str = Query("wav", alias="format"),
+    compression_level: float | None = Query(None),
+    bitrate_mode: str | None = Query(None),
+):
+    # Whole-song / multi-section render, mixed block by block straight from
+    # the song's samples and streamed. Outputs this size are not kept in the
+    # render cache.
+    song = song_store.get(song_id)
+    if song is None:
+        return unknown_song(song_id)
+    try:
+        dsp.check_output_format(output_format, compression_level, bitrate_mode)
+        dsp.check_block_format(output_format, song.sr)
+        spans = parse_sections(sections) if sections is not None else None
+        pack_id = await resolve_voice_pack([v1, v2, v3, v4, v5, v6, v7, v8], voice_pack)
+        block_size = int(round((block_sec if block_sec > 0 else 1.0) * song.sr))
+        headers = audio_headers(output_format, "bypass", name="countcoach_song")
+
+        slot = await render_slot()
         try:
-            os.remove(audio_path)
-        except:
-            pass
+            segments = await full_render_segments(song, spans, pack_id, voice_advance_ms, voice_target_rms)
+            if output_format == "wav":
+                # The peak passes run on the pool; the final pass is mixed as
+                # the client reads, in Starlette's threadpool, holding the slot
+                n = sum(end - start for start, end, *_ in segments)
+                peaks = await run_dsp(
+                    dsp.render_block_peaks, song_samples(song), segments, song.sr, song_gain, voice_gain, block_size,
+                )
+                blocks = dsp.iter_render_blocks(song.y, segments, song.sr, song_gain, voice_gain, block_size, peaks)
+                headers["Content-Length"] = str(len(dsp.wav_header(n, song.sr)) + 2 * n)
+                return HeldStreamingResponse(
+                    dsp.iter_wav_pcm16(blocks, n, song.sr), media_type="audio/wav", headers=headers, slot=slot,
+                )
+
+            path = await run_dsp(
+                dsp.render_blocks_to_file, song_samples(song), segments, song.sr, song_gain, voice_gain,
+                block_size, output_format, compression_level, bitrate_mode,
+            )
+        except BaseException:
+            slot.release()
+            raise
+        # The file is done; sending it needs no slot
+        slot.release()
+        headers["Content-Length"] = str(os.path.getsize(path))
+        media_type = dsp.OUTPUT_FORMATS[output_format][2]
+        return StreamingResponse(iter_file_chunks(path), media_type=media_type, headers=headers)
+    except Exception as e:
+        return error_response(e)
+
+
+@app.post("/jobs/render")
+async def submit_render_job(
+    song_id: str = Query(...),
+    # voice files: all of 1..8, or none to use voice_pack
+    v1: UploadFile | None = File(None),
+    v2: UploadFile | None = File(None),
+    v3: UploadFile | None = File(None),
+    v4: UploadFile | None = File(None),
+    v5: UploadFile | None = File(None),
+    v6: UploadFile | None = File(None),
+    v7: UploadFile | None = File(None),
+    v8: UploadFile | None = File(None),
+    # JSON [[start, end], ...] rendered back to back; omitted = the whole song
+    sections: str | None = Query(None),
+    voice_pack: str = Query(DEFAULT_PACK_ID),
+
+    voice_advance_ms: float = Query(70.0),
+    voice_target_rms: float = Query(0.13),
+    song_gain: float = Query(0.75),
+    voice_gain: float = Query(2.0),
+    block_sec: float = Query(1.0),
+
+    output_format: str = Query("wav", alias="format"),
+    compression_level: float | None = Query(None),
+    bitrate_mode: str | None = Query(None),
+):
+    # /songs/{song_id}/render/full as a background job: 202 with a job id at
+    # once; poll GET /jobs/{job_id}, then fetch GET /jobs/{job_id}/result
+    song = song_store.get(song_id)
+    if song is None:
+        return unknown_song(song_id)
+    try:
+        dsp.check_output_format(output_format, compression_level, bitrate_mode)
+        dsp.check_block_format(output_format, song.sr)
+        spans = parse_sections(sections) if sections is not None else None
+        # Voice uploads only live as long as this request
+        pack_id = await resolve_voice_pack([v1, v2, v3, v4, v5, v6, v7, v8], voice_pack)
+        block_size = int(round((block_sec if block_sec > 0 else 1.0) * song.sr))
+        _, _, media_type, ext, _ = dsp.OUTPUT_FORMATS[output_format]
+
+        async def run(job):
+            job.stage = "analyzing"
+            segments = await full_render_segments(song, spans, pack_id, voice_advance_ms, voice_target_rms)
+            job.stage = "rendering"
+            path = await run_dsp(
+                dsp.render_blocks_to_file, song_samples(song), segments, song.sr, song_gain, voice_gain,
+                block_size, output_format, compression_level, bitrate_mode,
+                job_queue.result_file(job.job_id, ext), job.progress_path,
+                timeout_s=JOB_TIMEOUT_S,
+            )
+            return path, media_type, f"countcoach_song.{ext}"
+
+        # An uploaded pack sits in the registry's LRU; hold it so uploads that
+        # arrive while this job is queued can't evict it before it runs
+        voice_packs.hold(pack_id)
+        try:
+            job = job_queue.submit("render", run, on_finish=lambda job: voice_packs.release(pack_id))
+        except Exception:
+            voice_packs.release(pack_id)
+            raise
+        return JSONResponse(status_code=202, content={"ok": True, **job_queue.info(job)})
+    except Exception as e:
+        return error_response(e)
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    try:
+        return {"ok": True, **job_queue.info(job_queue.get(job_id))}
+    except Exception as e:
+        return error_response(e)
+
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    try:
+        job = job_queue.result(job_id)
+        return FileResponse(job.result_path, media_type=job.media_type, filename=job.filename)
+    except Exception as e:
+        return error_response(e)
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    # Cancels a queued/running job, or drops a finished job's result early
+    try:
+        return {"ok": True, **job_queue.info(job_queue.cancel(job_id))}
+    except Exception as e:
+        return error_response(e)
+
+
+@app.post("/stems/{stems_id}/mix")
+async def mix_stems(
+    stems_id: str,
+    song_gain: float = Query(0.75),
+    voice_gain: float = Query(2.0),
+    block_sec: float = Query(1.0),
+    output_format: str = Query("wav", alias="format"),
+    compression_level: float | None = Query(None),
+    bitrate_mode: str | None = Query(None),
+):
+    # Re-run only the mix stage on stems kept from an earlier render
+    stems = stem_cache.get(stems_id)
+    if stems is None:
+        return JSONResponse(
+            status_code=404,
+            content={"ok": False, "error": f"Unknown or expired stems_id {stems_id!r}; render the section again"},
+        )
+    try:
+        dsp.check_output_format(output_format, compression_level, bitrate_mode)
+        song_base, voice_track, sr = stems
+        response = await audio_response(
+            song_base, voice_track, sr, song_gain, voice_gain, block_sec,
+            output_format, compression_level, bitrate_mode,
+        )
+        response.headers["X-Stems-Id"] = stems_id
+        return response
+    except Exception as e:
+        return error_response(e)
@@ -0,0 +1,189 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import contextvars
+import threading
+import time
+
+
+# ----------------------------
+# Stage timing
+# ----------------------------
+# DSP functions wrap their steps in stage("decode") etc. Inside a worker,
+# collect_stages() runs one task and returns its (name, seconds) list with
+# the result, so timings cross the process boundary with no shared state.
+# Outside a collect_stages() call, stage() only costs two perf_counter reads.
+
+_local = threading.local()
+
+@contextmanager
+def stage(name: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages = getattr(_local, "stages", None)
+        if stages is not None:
+            stages.append((name, time.perf_counter() - t0))
+
+def collect_stages(fn, *args):
+    _local.stages = []
+    try:
+        result = fn(*args)
+        return result, _local.stages
+    finally:
+        _local.stages = None
+
+
+class StageTimer:
+    # Per-request stage durations; repeated stages are summed
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self._stages: "OrderedDict[str, float]" = OrderedDict()
+
+    def add(self, name: str, seconds: float):
+        self._stages[name] = self._stages.get(name, 0.0) + float(seconds)
+
+    @contextmanager
+    def stage(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.t0
+
+    def items(self) -> list[tuple[str, float]]:
+        return list(self._stages.items())
+
+    def server_timing(self) -> str:
+        parts = [f"{name};dur={sec * 1000:.1f}" for name, sec in self._stages.items()]
+        parts.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(parts)
+
+# Timer of the request being handled (set by StageTimingMiddleware)
+current_timer: "contextvars.ContextVar[StageTimer | None]" = contextvars.ContextVar("current_timer", default=None)
+
+
+# ----------------------------
+# Prometheus-style metrics
+# ----------------------------
+# Hand-rolled text exposition (no client library dependency): one latency
+# histogram per (endpoint, stage) and a request counter per (endpoint, status).
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _labels(**labels) -> str:
+    body = ",".join(f'{k}="{str(v)}"' for k, v in labels.items())
+    return "{" + body + "}" if body else ""
+
+
+class Metrics:
+    def __init__(self, prefix: str = "countcoach", buckets: tuple = DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(sorted(buckets))
+        # (endpoint, stage) -> [per-bucket counts..., sum, count]
+        self._stages: dict[tuple, list] = {}
+        self._requests: dict[tuple, int] = {}
+        # name -> (type, help, fn() -> [(labels dict, value), ...]), read at scrape time
+        self._collected: dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint: str, stage_name: str, seconds: float):
+        with self._lock:
+            h = self._stages.get((endpoint, stage_name))
+            if h is None:
+                h = self._stages[(endpoint, stage_name)] = [0] * len(self.buckets) + [0.0, 0]
+            for i, le in enumerate(self.buckets):
+                if seconds <= le:
+                    h[i] += 1
+            h[-2] += seconds
+            h[-1] += 1
+
+    def observe_timer(self, endpoint: str, timer: StageTimer):
+        for name, sec in timer.items():
+            self.observe(endpoint, name, sec)
+
+    def register(self, name: str, kind: str, help_text: str, fn):
+        # Gauges/counters owned by another component (e.g. admission control)
+        self._collected[name] = (kind, help_text, fn)
+
+    def count_request(self, endpoint: str, status: int):
+        with self._lock:
+            key = (endpoint, int(status))
+            self._requests[key] = self._requests.get(key, 0) + 1
+
+    def render(self) -> str:
+        name = f"{self.prefix}_stage_seconds"
+        lines = [
+            f"# HELP {name} Time spent per request stage.",
+            f"# TYPE {name} histogram",
+        ]
+        with self._lock:
+            stages = sorted(self._stages.items())
+            requests = sorted(self._requests.items())
+        for (endpoint, stage_name), h in stages:
+            for le, n in zip(self.buckets, h):
+                lines.append(f"{name}_bucket{_labels(endpoint=endpoint, stage=stage_name, le=f'{le:g}')} {n}")
+            lines.append(f"{name}_bucket{_labels(endpoint=endpoint, stage=stage_name, le='+Inf')} {h[-1]}")
+            lines.append(f"{name}_sum{_labels(endpoint=endpoint, stage=stage_name)} {h[-2]:.6f}")
+            lines.append(f"{name}_count{_labels(endpoint=endpoint, stage=stage_name)} {h[-1]}")
+
+        name = f"{self.prefix}_requests_total"
+        lines += [f"# HELP {name} Requests handled.", f"# TYPE {name} counter"]
+        for (endpoint, status), n in requests:
+            lines.append(f"{name}{_labels(endpoint=endpoint, status=status)} {n}")
+
+        for name, (kind, help_text, fn) in sorted(self._collected.items()):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for labels, value in fn():
+                lines.append(f"{name}{_labels(**labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+# ----------------------------
+# ASGI middleware
+# ----------------------------
+# Gives every HTTP request a StageTimer, adds Server-Timing (stages finished
+# before the response starts) and, once the body is sent, records all stages
+# plus send/total. Plain ASGI rather than BaseHTTPMiddleware, so streaming
+# bodies pass straight through and Request.is_disconnected() keeps working.
+
+class StageTimingMiddleware:
+    def __init__(self, app, metrics: Metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timer = StageTimer()
+        token = current_timer.set(timer)
+        status = 500
+        headers_at = None
+
+        async def send_timed(message):
+            nonlocal status, headers_at
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timer.server_timing().encode("latin-1")))
+                message = {**message, "headers": headers}
+                headers_at = timer.elapsed()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            current_timer.reset(token)
+            if headers_at is not None:
+                timer.add("send", timer.elapsed() - headers_at)
+            timer.add("total", timer.elapsed())
+            # The router stores the matched route in the scope
+            endpoint = getattr(scope.get("route"), "path", "unmatched")
+            self.metrics.observe_timer(endpoint, timer)
+            self.metrics.count_request(endpoint, status)
@@ -0,0 +1,136 @@
+import os
+import struct
+import tempfile
+import threading
+
+import numpy as np
+
+
+# ----------------------------
+# Memory-mapped PCM cache
+# ----------------------------
+# Decoded mono songs persisted as raw float32 behind a 16-byte header
+# (magic, sample rate, frame count) and np.memmap-ed on access. Every process
+# that opens the same song shares its pages through the OS page cache, so
+# handing a song to a DSP worker is just handing over a path, and a track
+# seen before (even by another worker process or before a restart) loads
+# without decoding. Files are evicted oldest-mtime first over the byte budget.
+
+PCM_MAGIC = b"CCPCM\x00\x01\x00"
+PCM_HEADER = struct.Struct("<8sII")
+
+
+def write_pcm(path: str, y: np.ndarray, sr: int):
+    # Atomic: written next to path, then renamed into place
+    y = np.ascontiguousarray(y, dtype="<f4")
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(PCM_HEADER.pack(PCM_MAGIC, int(sr), len(y)))
+            f.write(y.tobytes())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+def open_pcm(path: str) -> tuple[np.ndarray, int]:
+    # Read-only float32 memmap of the samples, and the sample rate
+    with open(path, "rb") as f:
+        magic, sr, frames = PCM_HEADER.unpack(f.read(PCM_HEADER.size))
+    if magic != PCM_MAGIC:
+        raise ValueError(f"{path} is not a PCM cache file")
+    if frames == 0:
+        return np.zeros(0, dtype=np.float32), int(sr)
+    y = np.memmap(path, dtype="<f4", mode="r", offset=PCM_HEADER.size, shape=(frames,))
+    return y, int(sr)
+
+def as_samples(y_or_path) -> np.ndarray:
+    # DSP entry points accept either an array or a PCM cache path
+    if isinstance(y_or_path, str):
+        return open_pcm(y_or_path)[0]
+    return y_or_path
+
+
+class PCMCache:
+    def __init__(self, cache_dir: str | None, max_bytes: int):
+        self.cache_dir = cache_dir or None
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.cache_dir is not None
+
+    def path(self, song_id: str) -> str:
+        return os.path.join(self.cache_dir, f"{song_id}.f32")
+
+    def open(self, song_id: str) -> tuple[np.ndarray, int] | None:
+        if not self.enabled:
+            return None
+        path = self.path(song_id)
+        try:
+            y, sr = open_pcm(path)
+            os.utime(path)  # mtime doubles as last-access for eviction
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return y, sr
+
+    def exists(self, song_id: str) -> bool:
+        return self.enabled and os.path.exists(self.path(song_id))
+
+    def evict(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith(".f32"):
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+            # Unlinking a file that is still mapped is safe: the mapping keeps it alive
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+
+    def stats(self) -> dict:
+        files, total = 0, 0
+        if self.enabled:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(".f32"):
+                    files += 1
+                    try:
+                        total += os.path.getsize(os.path.join(self.cache_dir, name))
+                    except OSError:
+                        pass
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "files": files,
+                "bytes": total,
+                "max_bytes": self.max_bytes,
+                "dir": self.cache_dir,
+            }
@@ -0,0 +1,104 @@
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import threading
+
+import numpy as np
+
+from dsp import SECTION_HOP_LENGTH
+
+
+# ----------------------------
+# Content-addressed song store
+# ----------------------------
+# Songs are keyed by the sha256 of the uploaded bytes and hold the decoded
+# mono float32 PCM, so a track is uploaded and decoded once per session
+# instead of on every section change.
+
+@dataclass
+class Song:
+    song_id: str
+    y: np.ndarray
+    sr: int
+
+    # Whole-track analysis, filled in once (see main.ensure_song_analysis)
+    hop_length: int = SECTION_HOP_LENGTH
+    # Rate the envelope frames refer to (<= sr; see dsp.analysis_rate)
+    analysis_sr: int | None = None
+    oenv: np.ndarray | None = None
+    bpm: float | None = None
+    beat_times: np.ndarray | None = None
+    # The one in-flight whole-track analysis, shared by every request waiting on it
+    analysis_task: asyncio.Task | None = field(default=None, repr=False, compare=False)
+    # PCM cache file y is mapped from (see pcm.py); workers open it by path
+    pcm_path: str | None = None
+
+    @property
+    def duration(self) -> float:
+        return len(self.y) / float(self.sr)
+
+    @property
+    def nbytes(self) -> int:
+        # Memory-mapped samples count too: read pages stay resident in the
+        # page cache, and the mapping keeps the PCM file's blocks alive
+        # even after the PCM cache has unlinked it
+        n = int(self.y.nbytes)
+        if self.oenv is not None:
+            n += int(self.oenv.nbytes)
+        return n
+
+
+class SongStore:
+    # LRU over decoded songs, bounded by total PCM bytes (heap or mapped).
+    # Evicting drops the store's reference, which unmaps a mapped song once
+    # requests still using it have finished.
+    def __init__(self, max_bytes: int):
+        self.max_bytes = int(max_bytes)
+        # song_id -> (song, bytes accounted when it was added)
+        self._songs: "OrderedDict[str, tuple[Song, int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, song_id: str) -> bool:
+        with self._lock:
+            return song_id in self._songs
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._songs)
+
+    @property
+    def nbytes(self) -> int:
+        return self._bytes
+
+    def get(self, song_id: str) -> Song | None:
+        with self._lock:
+            entry = self._songs.get(song_id)
+            if entry is None:
+                return None
+            self._songs.move_to_end(song_id)
+            return entry[0]
+
+    def add(self, song: Song) -> Song:
+        if not isinstance(song.y, np.memmap):
+            song.y = np.ascontiguousarray(song.y, dtype=np.float32)
+        size = song.nbytes
+        with self._lock:
+            old = self._songs.pop(song.song_id, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._songs[song.song_id] = (song, size)
+            self._bytes += size
+            # Always keep the newest song, even if it alone exceeds the budget
+            while self._bytes > self.max_bytes and len(self._songs) > 1:
+                _, (_, evicted_size) = self._songs.popitem(last=False)
+                self._bytes -= evicted_size
+        return song
+
+    def remove(self, song_id: str) -> bool:
+        with self._lock:
+            entry = self._songs.pop(song_id, None)
+            if entry is None:
+                return False
+            self._bytes -= entry[1]
+            return True
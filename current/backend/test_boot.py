@@ -0,0 +1,48 @@
+import argparse
+import os
+import subprocess
+import sys
+
+import bench
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_fast_boot_within_import_budget():
+    args = argparse.Namespace(repeat=3, import_budget_ms=1000.0)
+    [result] = bench.bench_boot(args)
+    assert result["healthz_ok"]
+    assert result["heavy_modules_loaded"] == []
+    assert result["within_budget"], result
+
+
+# First use of the lazy librosa/soundfile modules from several threads at
+# once (COUNTCOACH_DSP_EXECUTOR=thread) must not see a half-imported module.
+# Runs in a fresh interpreter so nothing is imported yet.
+CONCURRENT_FIRST_USE = """
+import threading
+import numpy as np
+import dsp
+
+y = np.random.default_rng(0).standard_normal(44100 * 8).astype(np.float32) * 0.1
+errors = []
+start = threading.Barrier(16)
+
+def use():
+    start.wait()
+    try:
+        dsp.beat_track_section(y, 44100, 0.0, 8.0, 22050)
+        dsp.encode_audio(y[:44100], 44100, "wav")
+    except Exception as e:
+        errors.append(repr(e))
+
+threads = [threading.Thread(target=use) for _ in range(16)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+assert not errors, errors
+"""
+
+def test_lazy_modules_concurrent_first_use():
+    subprocess.run([sys.executable, "-c", CONCURRENT_FIRST_USE], cwd=HERE, check=True, timeout=300)
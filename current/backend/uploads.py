@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import tempfile
+
+
+# ----------------------------
+# Upload ingestion
+# ----------------------------
+# Uploads are copied to a temp file in fixed-size chunks, hashed as they go
+# (the sha256 is the song / voice-pack content address) and rejected as soon
+# as they turn out to be too large or not audio, so memory stays flat no
+# matter how big or how many the uploads are.
+
+UPLOAD_CHUNK_BYTES = 1 << 20
+
+
+class UploadTooLarge(ValueError):
+    pass
+
+class UnsupportedUpload(ValueError):
+    pass
+
+
+def sniff_audio(head: bytes) -> str | None:
+    # Container/codec from the first bytes of a file, or None if unrecognized
+    if head[:4] == b"RIFF" and head[8:12] in (b"WAVE", b"RF64"):
+        return "wav"
+    if head[:4] == b"RF64" or head[:4] == b"BW64":
+        return "wav"
+    if head[:4] == b"fLaC":
+        return "flac"
+    if head[:4] == b"OggS":
+        return "ogg"
+    if head[:3] == b"ID3" or (len(head) >= 2 and head[0] == 0xFF and (head[1] & 0xE0) == 0xE0):
+        return "mp3"  # also matches raw ADTS AAC, which decodes the same way
+    if head[:4] == b"FORM" and head[8:12] in (b"AIFF", b"AIFC"):
+        return "aiff"
+    if head[4:8] == b"ftyp":
+        return "mp4"
+    if head[:4] == b"\x1a\x45\xdf\xa3":
+        return "webm"
+    if head[:4] == b"caff":
+        return "caf"
+    return None
+
+
+def save_upload(fileobj, filename: str | None, max_bytes: int) -> tuple[str, str]:
+    # Stream fileobj to a temp file. Returns (path, sha256 hex digest).
+    suffix = os.path.splitext(filename or "")[1].lower() or ".wav"
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                chunk = fileobj.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                if size == 0 and sniff_audio(chunk[:16]) is None:
+                    raise UnsupportedUpload(f"{filename or 'upload'} does not look like an audio file")
+                size += len(chunk)
+                if max_bytes > 0 and size > max_bytes:
+                    raise UploadTooLarge(f"{filename or 'upload'} is larger than {max_bytes // (1 << 20)} MB")
+                digest.update(chunk)
+                f.write(chunk)
+        if size == 0:
+            raise UnsupportedUpload(f"{filename or 'upload'} is empty")
+    except BaseException:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        raise
+    return path, digest.hexdigest()
+
+
+class RequestSizeLimit:
+    # ASGI middleware capping the request body. A declared Content-Length over
+    # the limit is refused before any of the body is read; otherwise bytes are
+    # counted as they arrive and the request is cut off (the app sees a client
+    # disconnect) the moment the limit is crossed.
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = int(max_bytes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.max_bytes <= 0:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        try:
+            declared = int(headers.get(b"content-length", b"-1"))
+        except ValueError:
+            declared = -1
+        if declared > self.max_bytes:
+            await self._reject(send)
+            return
+
+        received = 0
+        too_large = False
+        started = False
+
+        async def limited_receive():
+            nonlocal received, too_large
+            if too_large:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    too_large = True
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message):
+            nonlocal started
+            if too_large:
+                return  # whatever the app makes of the cut-off body is replaced below
+            started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not too_large:
+                raise
+        if too_large and not started:
+            await self._reject(send)
+
+    async def _reject(self, send):
+        body = json.dumps({
+            "ok": False,
+            "error": f"Request body is larger than {self.max_bytes // (1 << 20)} MB",
+        }).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,231 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import hashlib
+import threading
+
+
+# ----------------------------
+# Voice pack registry
+# ----------------------------
+# A pack is the eight count samples ("1".."8") decoded once at their native
+# sample rate. Renders ask for processed variants, which are cached in three
+# levels:
+#   bank    (pack, sr)                                resampled + trimmed
+#   base    (pack, sr, target_rms)                    bank entry, RMS-matched
+#   variant (pack, sr, target_rms, max_n, fade_n)      cropped + faded for a beat length
+# Bank entries at the common song rates (BANK_RATES) are built when a pack is
+# registered and never evicted; other rates are built on first use and kept
+# in a small LRU. So resampling never runs on the render path for 22.05, 44.1
+# or 48 kHz songs, and at most once per pack for anything else.
+#
+# Packs registered explicitly (POST /voice-packs) and the bundled default are
+# pinned. Packs that arrive as v1..v8 uploads on a render are kept in an LRU
+# of max_upload_packs; evicting one drops everything cached for it. hold()
+# keeps an uploaded pack out of eviction until release() (e.g. while a
+# queued job still needs it).
+
+VOICE_COUNTS = tuple(range(1, 9))
+DEFAULT_PACK_ID = "default"
+BANK_RATES = (22050, 44100, 48000)
+
+
+class UnknownVoicePack(LookupError):
+    pass
+
+
+@dataclass
+class VoicePack:
+    pack_id: str
+    # count -> (mono float32 samples, native sample rate)
+    samples: dict = field(default_factory=dict)
+
+    @property
+    def nbytes(self) -> int:
+        return int(sum(y.nbytes for y, _ in self.samples.values()))
+
+
+def pack_id_for_hashes(hashes: list[str]) -> str:
+    # Content address of a pack: hash of its per-count file hashes, in order
+    h = hashlib.sha256()
+    for file_hash in hashes:
+        h.update(file_hash.encode("ascii"))
+    return h.hexdigest()
+
+def pack_id_for_files(paths: list[str], chunk_size: int = 1 << 20) -> str:
+    # Same address for pack files on disk (e.g. the bundled pack)
+    hashes = []
+    for path in paths:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                h.update(chunk)
+        hashes.append(h.hexdigest())
+    return pack_id_for_hashes(hashes)
+
+def base_key(pack_id: str, sr: int, target_rms: float) -> tuple:
+    return (pack_id, int(sr), float(round(target_rms, 6)))
+
+def variant_key(pack_id: str, sr: int, target_rms: float, max_voice_sec: float, fade_sec: float) -> tuple:
+    # Durations are keyed in samples: that is the resolution crop/fade work at
+    max_n = max(1, int(round(max_voice_sec * sr)))
+    fade_n = int(round(fade_sec * sr))
+    return base_key(pack_id, sr, target_rms) + (max_n, fade_n)
+
+
+class VoicePackRegistry:
+    def __init__(self, max_bases: int = 64, max_variants: int = 512,
+                 bank_rates: tuple = BANK_RATES, max_lazy_banks: int = 16,
+                 max_upload_packs: int = 8):
+        self.max_bases = int(max_bases)
+        self.max_variants = int(max_variants)
+        self.bank_rates = tuple(int(r) for r in bank_rates)
+        self.max_lazy_banks = int(max_lazy_banks)
+        self.max_upload_packs = int(max_upload_packs)
+        self._packs: dict[str, VoicePack] = {}
+        self._upload_packs: "OrderedDict[str, VoicePack]" = OrderedDict()
+        self._holds: dict[str, int] = {}
+        self._banks: dict[tuple, dict] = {}
+        self._lazy_banks: "OrderedDict[tuple, dict]" = OrderedDict()
+        self._bases: "OrderedDict[tuple, dict]" = OrderedDict()
+        self._variants: "OrderedDict[tuple, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, pack_id: str) -> bool:
+        with self._lock:
+            return self._has(pack_id)
+
+    def ids(self) -> list[str]:
+        with self._lock:
+            return list(self._packs) + list(self._upload_packs)
+
+    def get(self, pack_id: str) -> VoicePack | None:
+        with self._lock:
+            pack = self._packs.get(pack_id)
+            if pack is None:
+                pack = self._upload_packs.get(pack_id)
+                if pack is not None:
+                    self._upload_packs.move_to_end(pack_id)
+            return pack
+
+    def add(self, pack: VoicePack, pinned: bool = True) -> VoicePack:
+        missing = [k for k in VOICE_COUNTS if k not in pack.samples]
+        if missing:
+            raise ValueError(f"Voice pack is missing counts {missing}")
+        with self._lock:
+            self._packs.pop(pack.pack_id, None)
+            self._upload_packs.pop(pack.pack_id, None)
+            # Re-registering an id must not serve stale processed audio
+            self._drop_cached(pack.pack_id)
+            if pinned:
+                self._packs[pack.pack_id] = pack
+            else:
+                self._upload_packs[pack.pack_id] = pack
+                self._evict_uploads()
+        return pack
+
+    def hold(self, pack_id: str) -> bool:
+        with self._lock:
+            if not self._has(pack_id):
+                return False
+            self._holds[pack_id] = self._holds.get(pack_id, 0) + 1
+            return True
+
+    def release(self, pack_id: str):
+        with self._lock:
+            n = self._holds.pop(pack_id, 0) - 1
+            if n > 0:
+                self._holds[pack_id] = n
+            self._evict_uploads()
+
+    def pin(self, pack_id: str) -> bool:
+        # An uploaded pack that is then registered explicitly stays for good
+        with self._lock:
+            pack = self._upload_packs.pop(pack_id, None)
+            if pack is not None:
+                self._packs[pack_id] = pack
+            return pack_id in self._packs
+
+    def remove(self, pack_id: str) -> bool:
+        with self._lock:
+            if self._packs.pop(pack_id, None) is None and self._upload_packs.pop(pack_id, None) is None:
+                return False
+            self._drop_cached(pack_id)
+            return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pinned": len(self._packs),
+                "uploaded": len(self._upload_packs),
+                "max_uploaded": self.max_upload_packs,
+                "banks": len(self._banks) + len(self._lazy_banks),
+                "bases": len(self._bases),
+                "variants": len(self._variants),
+            }
+
+    def _evict_uploads(self):
+        # Oldest first, skipping held packs and always keeping the newest (the
+        # render that just uploaded it still needs it); the LRU may run over
+        # while packs are held
+        over = len(self._upload_packs) - self.max_upload_packs
+        candidates = [p for p in list(self._upload_packs)[:-1] if p not in self._holds]
+        for pack_id in candidates[:max(0, over)]:
+            del self._upload_packs[pack_id]
+            self._drop_cached(pack_id)
+
+    def _has(self, pack_id: str) -> bool:
+        return pack_id in self._packs or pack_id in self._upload_packs
+
+    def _drop_cached(self, pack_id: str):
+        for cache in (self._banks, self._lazy_banks, self._bases, self._variants):
+            for key in [k for k in cache if k[0] == pack_id]:
+                del cache[key]
+
+    def get_bank(self, pack_id: str, sr: int) -> dict | None:
+        key = (pack_id, int(sr))
+        with self._lock:
+            entry = self._banks.get(key)
+        return entry if entry is not None else self._lookup(self._lazy_banks, key)
+
+    def put_bank(self, pack_id: str, sr: int, entry: dict):
+        # Precomputed rates are pinned; anything else goes through the LRU
+        key = (pack_id, int(sr))
+        if key[1] not in self.bank_rates:
+            self._store(self._lazy_banks, key, entry, self.max_lazy_banks)
+            return
+        with self._lock:
+            if self._has(pack_id):
+                self._banks[key] = entry
+
+    def bank_rates_for(self, pack_id: str) -> list[int]:
+        with self._lock:
+            keys = list(self._banks) + list(self._lazy_banks)
+        return sorted(sr for pid, sr in keys if pid == pack_id)
+
+    def get_base(self, key: tuple) -> dict | None:
+        return self._lookup(self._bases, key)
+
+    def put_base(self, key: tuple, bases: dict):
+        self._store(self._bases, key, bases, self.max_bases)
+
+    def get_variant(self, key: tuple) -> dict | None:
+        return self._lookup(self._variants, key)
+
+    def put_variant(self, key: tuple, samples: dict):
+        self._store(self._variants, key, samples, self.max_variants)
+
+    def _lookup(self, cache: OrderedDict, key: tuple) -> dict | None:
+        with self._lock:
+            value = cache.get(key)
+            if value is not None:
+                cache.move_to_end(key)
+            return value
+
+    def _store(self, cache: OrderedDict, key: tuple, value: dict, max_entries: int):
+        with self._lock:
+            if not self._has(key[0]):
+                return
+            cache[key] = value
+            cache.move_to_end(key)
+            while len(cache) > max_entries:
+                cache.popitem(last=False)
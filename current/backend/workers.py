@@ -0,0 +1,170 @@
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+import asyncio
+import multiprocessing
+import os
+import threading
+
+
+# ----------------------------
+# DSP execution layer
+# ----------------------------
+# librosa/soundfile work is CPU-bound and blocks the event loop if called
+# from an async endpoint. DSPPool runs it on a process pool so concurrent
+# requests spread across cores, with a bounded number of waiting tasks and a
+# per-call timeout.
+
+class PoolBusy(Exception):
+    pass
+
+class PoolTimeout(Exception):
+    pass
+
+class Superseded(Exception):
+    pass
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class DSPPool:
+    def __init__(self, workers: int, max_queue: int, timeout_s: float,
+                 kind: str = "process", start_method: str = "spawn", initializer=None):
+        if kind not in ("process", "thread"):
+            raise ValueError(f"Unknown DSP executor kind {kind!r} (expected 'process' or 'thread')")
+        self.workers = max(1, int(workers))
+        self.max_queue = max(0, int(max_queue))
+        self.timeout_s = float(timeout_s)
+        self.kind = kind
+        self.start_method = start_method
+        # Runs once in every worker before its first task (e.g. dsp.warm_up)
+        self.initializer = initializer
+        self._executor: Executor | None = None
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    @property
+    def pending(self) -> int:
+        # Tasks running or waiting for a worker
+        return self._pending
+
+    @property
+    def capacity(self) -> int:
+        return self.workers + self.max_queue
+
+    def _get_executor(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                if self.kind == "process":
+                    ctx = multiprocessing.get_context(self.start_method)
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers, mp_context=ctx, initializer=self.initializer,
+                    )
+                else:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix="dsp", initializer=self.initializer,
+                    )
+            return self._executor
+
+    async def run(self, fn, *args, timeout_s: float | None = None):
+        with self._lock:
+            if self._pending >= self.capacity:
+                raise PoolBusy(f"DSP queue is full ({self._pending} tasks pending); try again shortly")
+            self._pending += 1
+
+        try:
+            cfut = self._get_executor().submit(fn, *args)
+        except BaseException:
+            self._release()
+            raise
+        # The slot is freed when the worker is actually done with the task, not
+        # when the caller stops waiting: a timed-out or cancelled task that is
+        # already running cannot be interrupted and still occupies a worker.
+        # One that is still queued is dropped by the cancel below.
+        cfut.add_done_callback(lambda _: self._release())
+
+        timeout = self.timeout_s if timeout_s is None else timeout_s
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(cfut), timeout=timeout if timeout > 0 else None)
+        except asyncio.TimeoutError:
+            cfut.cancel()
+            raise PoolTimeout(f"DSP stage {getattr(fn, '__name__', fn)!s} timed out after {timeout:g}s")
+        except asyncio.CancelledError:
+            cfut.cancel()
+            raise
+
+    async def start(self, timeout_s: float | None = None) -> int:
+        # Bring every worker up now (running the initializer) instead of on
+        # the first requests. Workers are spawned on demand, so this keeps
+        # one task per worker in flight until all have reported in.
+        manager = None
+        if self.kind == "process":
+            # A manager proxy, since plain mp barriers cannot be pickled into tasks
+            manager = multiprocessing.get_context(self.start_method).Manager()
+            barrier = manager.Barrier(self.workers)
+        else:
+            barrier = threading.Barrier(self.workers)
+        try:
+            tasks = [self.run(_wait_at, barrier, timeout_s=timeout_s) for _ in range(self.workers)]
+            return len(set(await asyncio.gather(*tasks)))
+        finally:
+            if manager is not None:
+                manager.shutdown()
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _wait_at(barrier, timeout_s: float = 120.0) -> str:
+    # Holds its worker until all workers have one, so each task lands on a
+    # distinct worker; returns an id of the worker it ran on
+    try:
+        barrier.wait(timeout_s)
+    except threading.BrokenBarrierError:
+        pass
+    return f"{os.getpid()}:{threading.get_ident()}"
+
+
+# ----------------------------
+# Request supersession
+# ----------------------------
+# Requests may carry a key (e.g. one per browser session). A newer request
+# with the same key cancels the older one's task, which drops its queued pool
+# work and discards its result.
+
+class LatestRequests:
+    def __init__(self):
+        self._tasks: dict[str, asyncio.Task] = {}
+
+    def claim(self, key: str, task: asyncio.Task) -> bool:
+        prev = self._tasks.get(key)
+        self._tasks[key] = task
+        if prev is not None and not prev.done():
+            prev.cancel()
+            return True
+        return False
+
+    def release(self, key: str, task: asyncio.Task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+
+def pool_from_env(initializer=None, kind: str | None = None) -> DSPPool:
+    workers = int(os.environ.get("COUNTCOACH_DSP_WORKERS", "0")) or (os.cpu_count() or 1)
+    return DSPPool(
+        workers=workers,
+        max_queue=int(os.environ.get("COUNTCOACH_DSP_QUEUE", str(4 * workers))),
+        timeout_s=float(os.environ.get("COUNTCOACH_DSP_TIMEOUT_S", "120")),
+        kind=kind or os.environ.get("COUNTCOACH_DSP_EXECUTOR", "process"),
+        start_method=os.environ.get("COUNTCOACH_DSP_START_METHOD", "spawn"),
+        initializer=initializer,
+    )